@@ -0,0 +1,3 @@
+from range_bd.benchmark.runner import main
+
+main()
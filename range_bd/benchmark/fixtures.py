@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import shutil
+import subprocess
+from dataclasses import dataclass
+from io import BytesIO
+from pathlib import Path
+from zipfile import ZipFile
+
+import numpy as np
+from PIL import Image
+
+
+@dataclass
+class Settings:
+    pages: int = 10
+    width: int = 2000
+    height: int = 3000
+
+
+def make_page(settings: Settings, index: int) -> Image.Image:
+    # Smooth gradient with some noise: compresses roughly like a scanned page
+    rng = np.random.default_rng(index)
+    y = np.linspace(0, 255, settings.height, dtype=np.float32)[:, None, None]
+    x = np.linspace(0, 255, settings.width, dtype=np.float32)[None, :, None]
+    colour = rng.uniform(0.2, 1.0, size=3).astype(np.float32)
+    noise = rng.normal(0, 12, size=(settings.height, settings.width, 1))
+    page = (x + y) / 2 * colour + noise
+    return Image.fromarray(np.clip(page, 0, 255).astype(np.uint8), "RGB")
+
+
+def encode_page(image: Image.Image, format_: str = "JPEG") -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format=format_, quality=95)
+    return buffer.getvalue()
+
+
+def make_zip(path: Path, settings: Settings, macosx: bool = False) -> Path:
+    # Pages in a sub folder with unpadded numbers, as they are often found
+    with ZipFile(path, "w") as zip_:
+        for index in range(settings.pages):
+            data = encode_page(make_page(settings, index))
+            zip_.writestr(f"{path.stem}/page {index + 1}.jpg", data)
+            if macosx:
+                zip_.writestr(
+                    f"__MACOSX/{path.stem}/._page {index + 1}.jpg", b"\0" * 4096
+                )
+        zip_.writestr("ComicInfo.xml", "<ComicInfo></ComicInfo>")
+    return path
+
+
+def make_pdf(path: Path, settings: Settings) -> Path:
+    pages = [make_page(settings, index) for index in range(settings.pages)]
+    pages[0].save(path, "PDF", save_all=True, append_images=pages[1:], resolution=300)
+    return path
+
+
+def can_make_rar() -> bool:
+    return shutil.which("rar") is not None and shutil.which("unrar") is not None
+
+
+def make_rar(path: Path, settings: Settings) -> Path:
+    # Creating RAR archives needs the non-free rar binary
+    folder = path.with_suffix("")
+    folder.mkdir()
+    for index in range(settings.pages):
+        (folder / f"page {index + 1}.jpg").write_bytes(
+            encode_page(make_page(settings, index))
+        )
+
+    subprocess.run(
+        ["rar", "a", "-ep1", "-inul", str(path), str(folder)],
+        check=True,
+    )
+    shutil.rmtree(folder)
+    return path
+
+
+def make_pdf_pages(pdf_path: Path, settings: Settings) -> Path:
+    # Pages rasterised next to the PDF, as pdf_to_cbz.compress expects them
+    pdf_path.touch()
+    for index in range(settings.pages):
+        page_path = pdf_path.with_name(f"{pdf_path.stem}_Page.pdf-{index + 1}.png")
+        make_page(settings, index).save(page_path, compress_level=1)
+    return pdf_path
+
+
+def make_screenshot(path: Path, settings: Settings) -> Path:
+    # Page in the middle of a black screen, as the importer captures it
+    screen = Image.new("RGB", (settings.width + 400, settings.height + 200))
+    screen.paste(make_page(settings, 0), (200, 100))
+    screen.save(path, compress_level=1)
+    return path
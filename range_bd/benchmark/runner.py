@@ -0,0 +1,339 @@
+from __future__ import annotations
+
+import argparse
+import json
+import shutil
+import statistics
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from typing import Callable, Iterator
+from unittest import mock
+
+import send2trash
+
+from range_bd import pdf_to_cbz, sanitizer, unrar
+from range_bd.benchmark.fixtures import (
+    Settings,
+    can_make_rar,
+    make_pdf,
+    make_pdf_pages,
+    make_rar,
+    make_screenshot,
+    make_zip,
+)
+
+REPEAT = 3
+
+
+@dataclass
+class Benchmark:
+    name: str
+    # Create the fixture in the given folder and return the path to run on
+    fixture: Callable[[Path, Settings], Path]
+    run: Callable[[Path], object]
+    available: Callable[[], bool] = lambda: True
+    # Pages processed by one run, the fixture pages by default
+    pages: Callable[[Settings], int] = lambda settings: settings.pages
+
+
+@dataclass
+class Result:
+    name: str
+    pages: int
+    size: int
+    times: list[float] = field(default_factory=list)
+
+    @property
+    def best(self) -> float:
+        return min(self.times)
+
+    def to_dict(self) -> dict:
+        return {
+            "pages": self.pages,
+            "size": self.size,
+            "best": self.best,
+            "median": statistics.median(self.times),
+            "pages_per_s": self.pages / self.best,
+            "mb_per_s": self.size / 1e6 / self.best,
+        }
+
+
+def has_binary(*names: str) -> Callable[[], bool]:
+    return lambda: all(shutil.which(name) is not None for name in names)
+
+
+def has_importer() -> bool:
+    try:
+        from range_bd import importer  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def crop_edges(path: Path) -> object:
+    from range_bd import importer
+
+    return importer.crop_edges(path, None)
+
+
+def encode_page(resize: bool) -> Callable[[Path], object]:
+    def run(path: Path) -> object:
+        from range_bd import importer
+
+        png = path.read_bytes()
+        crop = importer.find_crop(importer.decode(png))
+        return importer.encode_page(png, crop, resize)
+
+    return run
+
+
+def action(name: str) -> Callable[[Path], object]:
+    actions = {action.__name__: action for action in sanitizer.ACTIONS}
+    return actions[name]
+
+
+def large_pages(settings: Settings) -> Settings:
+    # Pages at least twice as tall as the expected height, which can be
+    # decoded at half their size
+    height = max(settings.height, 2 * sanitizer.EXPECTED_HEIGHT)
+    return replace(
+        settings, width=settings.width * height // settings.height, height=height
+    )
+
+
+def transform_zip_with_draft(min_scale: float) -> Callable[[Path], object]:
+    def run(path: Path) -> object:
+        previous = sanitizer.DRAFT_MIN_SCALE
+        sanitizer.DRAFT_MIN_SCALE = min_scale
+        try:
+            return sanitizer.transform_zip(path)
+        finally:
+            sanitizer.DRAFT_MIN_SCALE = previous
+
+    return run
+
+
+BENCHMARKS: list[Benchmark] = [
+    Benchmark(
+        "sanitizer.change_tome_number_in_files",
+        lambda folder, settings: make_zip(folder / "BD Serie T01 .zip", settings),
+        action("change_tome_number_in_files"),
+    ),
+    Benchmark(
+        "sanitizer.rename_cbz",
+        lambda folder, settings: make_zip(folder / "Serie #01.cbz", settings),
+        action("rename_cbz"),
+    ),
+    Benchmark(
+        "sanitizer.unrar",
+        lambda folder, settings: make_rar(folder / "Serie #01.cbr", settings),
+        action("unrar"),
+        can_make_rar,
+    ),
+    Benchmark(
+        "sanitizer.convert_pdf",
+        lambda folder, settings: make_pdf(folder / "Serie #01.pdf", settings),
+        action("convert_pdf"),
+        has_binary("pdftoppm", "pdfinfo"),
+    ),
+    Benchmark(
+        "sanitizer.transform_zip",
+        lambda folder, settings: make_zip(folder / "Serie #01.zip", settings),
+        action("transform_zip"),
+    ),
+    Benchmark(
+        "sanitizer.transform_zip[__MACOSX]",
+        lambda folder, settings: make_zip(
+            folder / "Serie #01.zip", settings, macosx=True
+        ),
+        action("transform_zip"),
+    ),
+    Benchmark(
+        "sanitizer.transform_zip[large pages, full decode]",
+        lambda folder, settings: make_zip(
+            folder / "Serie #01.zip", large_pages(settings)
+        ),
+        transform_zip_with_draft(0),
+    ),
+    Benchmark(
+        "sanitizer.transform_zip[large pages, draft]",
+        lambda folder, settings: make_zip(
+            folder / "Serie #01.zip", large_pages(settings)
+        ),
+        transform_zip_with_draft(1.0),
+    ),
+    Benchmark(
+        "unrar.create_cbz",
+        lambda folder, settings: make_rar(folder / "Serie #01.cbr", settings),
+        unrar.create_cbz,
+        can_make_rar,
+    ),
+    Benchmark(
+        "pdf_to_cbz.compress",
+        lambda folder, settings: make_pdf_pages(folder / "Serie #01.pdf", settings),
+        pdf_to_cbz.compress,
+    ),
+    Benchmark(
+        "pdf_to_cbz.convert_pdf",
+        lambda folder, settings: make_pdf(folder / "Serie #01.pdf", settings),
+        pdf_to_cbz.convert_pdf,
+        has_binary("pdftoppm", "pdfinfo"),
+    ),
+    Benchmark(
+        "importer.crop_edges",
+        lambda folder, settings: make_screenshot(folder / "page.png", settings),
+        crop_edges,
+        has_importer,
+        lambda settings: 1,
+    ),
+    Benchmark(
+        "importer.encode_page",
+        lambda folder, settings: make_screenshot(folder / "page.png", settings),
+        encode_page(False),
+        has_importer,
+        lambda settings: 1,
+    ),
+    Benchmark(
+        "importer.encode_page[resize]",
+        lambda folder, settings: make_screenshot(folder / "page.png", settings),
+        encode_page(True),
+        has_importer,
+        lambda settings: 1,
+    ),
+]
+
+
+def remove(path: str | Path) -> None:
+    path = Path(path)
+    if path.is_dir():
+        shutil.rmtree(path)
+    else:
+        path.unlink()
+
+
+@contextmanager
+def no_trash() -> Iterator[None]:
+    # Actions send the books they replace to the trash: remove them instead,
+    # so that runs do not fill the user's trash
+    with (
+        mock.patch.object(send2trash, "send2trash", remove),
+        mock.patch.object(sanitizer, "send2trash", remove),
+    ):
+        yield
+
+
+def folder_size(folder: Path) -> int:
+    return sum(path.stat().st_size for path in folder.rglob("*") if path.is_file())
+
+
+def run_benchmark(
+    benchmark: Benchmark, settings: Settings, repeat: int, tmp_dir: Path
+) -> Result:
+    # The fixture is created once and copied before each run: actions modify
+    # the book they run on
+    fixture_folder = tmp_dir / "fixture"
+    fixture_folder.mkdir()
+    fixture = benchmark.fixture(fixture_folder, settings)
+    relative_path = fixture.relative_to(fixture_folder)
+
+    result = Result(
+        benchmark.name, benchmark.pages(settings), folder_size(fixture_folder)
+    )
+    for index in range(repeat):
+        run_folder = tmp_dir / f"run_{index}"
+        shutil.copytree(fixture_folder, run_folder)
+
+        with no_trash():
+            start = time.perf_counter()
+            benchmark.run(run_folder / relative_path)
+            result.times.append(time.perf_counter() - start)
+
+        shutil.rmtree(run_folder, ignore_errors=True)
+
+    return result
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict]) -> list[str]:
+    # Return the benchmarks slower than in the baseline, and print the ratios
+    slower: list[str] = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"{name:55} not in baseline")
+            continue
+
+        ratio = result["best"] / baseline[name]["best"]
+        print(
+            f"{name:55} {baseline[name]['best']:8.3f}s -> {result['best']:8.3f}s "
+            f"x{1 / ratio:5.2f}"
+        )
+        if ratio > 1:
+            slower.append(name)
+    return slower
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the range_bd stages")
+    parser.add_argument("--pages", type=int, default=Settings.pages)
+    parser.add_argument("--width", type=int, default=Settings.width)
+    parser.add_argument("--height", type=int, default=Settings.height)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument(
+        "-k", dest="filter", default="", help="Only run benchmarks containing it"
+    )
+    parser.add_argument("--save", type=Path, help="Save the results as JSON")
+    parser.add_argument("--compare", type=Path, help="Baseline JSON to compare to")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=None,
+        help="Fail when a benchmark is slower than the baseline by more than "
+        "this ratio, e.g. 0.1 for 10%%",
+    )
+    args = parser.parse_args()
+
+    settings = Settings(args.pages, args.width, args.height)
+
+    results: dict[str, dict] = {}
+    for benchmark in BENCHMARKS:
+        if args.filter not in benchmark.name:
+            continue
+
+        if not benchmark.available():
+            print(f"{benchmark.name:55} skipped: missing dependency")
+            continue
+
+        with TemporaryDirectory() as tmp_dir:
+            result = run_benchmark(benchmark, settings, args.repeat, Path(tmp_dir))
+
+        results[benchmark.name] = result.to_dict()
+        print(
+            f"{benchmark.name:55} {result.best:8.3f}s "
+            f"{results[benchmark.name]['pages_per_s']:8.1f} pages/s "
+            f"{results[benchmark.name]['mb_per_s']:8.1f} MB/s"
+        )
+
+    if args.save:
+        args.save.write_text(json.dumps(results, indent=2))
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        print(f"\nCompared to {args.compare}")
+        slower = compare(results, baseline)
+
+        if args.tolerance is not None:
+            regressions = [
+                name
+                for name in slower
+                if results[name]["best"] > baseline[name]["best"] * (1 + args.tolerance)
+            ]
+            if regressions:
+                print(f"Slower than the baseline: {', '.join(regressions)}")
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
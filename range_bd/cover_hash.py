@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from zipfile import BadZipFile, ZipFile
+
+import numpy as np
+from PIL import Image
+
+from range_bd.sanitizer import plan_page_names
+
+logger = logging.getLogger(__name__)
+
+FOLDER = Path(r"M:\Bédés\thumbnails")
+HASHES_NAME = "cover_hashes.npz"
+IMG_FILETYPES = {".png", ".jpg", ".gif"}
+# Books are hashed on their first page
+BOOK_FILETYPES = {".cbz", ".zip"}
+WORKERS = os.cpu_count() or 1
+# Covers at most this many bits apart are considered the same
+DISTANCE = 4
+
+HASH_SIZE = 8
+# pHash keeps the lowest frequencies of the DCT of a 32x32 image
+PHASH_SIZE = 32
+# Number of set bits of every byte
+POPCOUNT = np.array([bin(byte).count("1") for byte in range(256)], dtype=np.uint8)
+
+
+def dct_matrix(size: int) -> np.ndarray:
+    # Orthonormal DCT-II: dct_matrix @ x @ dct_matrix.T transforms rows and
+    # columns of x
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+DCT = dct_matrix(PHASH_SIZE)
+
+
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    # (N, 64) booleans to N uint64, first bit as the most significant
+    return np.packbits(bits.reshape(len(bits), -1), axis=1).view(">u8")[:, 0]
+
+
+def dhash(images: np.ndarray) -> np.ndarray:
+    # (N, 8, 9) grey levels: whether each pixel is brighter than its right
+    # neighbour
+    return pack_bits(images[:, :, 1:] > images[:, :, :-1]).astype(np.uint64)
+
+
+def phash(images: np.ndarray) -> np.ndarray:
+    # (N, 32, 32) grey levels: whether each low frequency is above their
+    # median, the DC term excluded
+    low = (DCT @ images @ DCT.T)[:, :HASH_SIZE, :HASH_SIZE].reshape(len(images), -1)
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    return pack_bits(low > median).astype(np.uint64)
+
+
+def hamming(hashes: np.ndarray, other: np.ndarray | int) -> np.ndarray:
+    xor = np.bitwise_xor(hashes, np.uint64(other) if np.isscalar(other) else other)
+    return POPCOUNT[xor.view(np.uint8)].reshape(*xor.shape, 8).sum(axis=-1)
+
+
+def open_cover(path: Path) -> Image.Image:
+    if path.suffix.lower() not in BOOK_FILETYPES:
+        return Image.open(path)
+
+    with ZipFile(path) as zip_:
+        pages = plan_page_names(zip_.namelist())
+        if not pages:
+            raise ValueError(f"No page in {path}")
+        return Image.open(BytesIO(zip_.read(pages[0][0])))
+
+
+def load_cover(path: Path) -> tuple[np.ndarray, np.ndarray]:
+    # Grey levels of the cover at the dHash and pHash sizes. JPEG covers are
+    # decoded at reduced size.
+    image = open_cover(path)
+    image.draft("L", (PHASH_SIZE, PHASH_SIZE))
+    image = image.convert("L")
+    small = np.asarray(
+        image.resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BILINEAR),
+        dtype=np.float32,
+    )
+    large = np.asarray(
+        image.resize((PHASH_SIZE, PHASH_SIZE), Image.Resampling.BILINEAR),
+        dtype=np.float32,
+    )
+    return small, large
+
+
+def find_covers(top_path: Path) -> list[Path]:
+    return sorted(
+        path
+        for path in top_path.rglob("*")
+        if path.suffix.lower() in IMG_FILETYPES | BOOK_FILETYPES and path.is_file()
+    )
+
+
+def load_or_none(path: Path) -> tuple[np.ndarray, np.ndarray] | None:
+    try:
+        return load_cover(path)
+    except (OSError, ValueError, BadZipFile) as exc:
+        logger.warning("Cannot hash %s: %s", path, exc)
+        return None
+
+
+def hash_covers(
+    paths: list[Path], workers: int = WORKERS
+) -> tuple[list[Path], np.ndarray, np.ndarray]:
+    # Paths which could be read, with their dHash and pHash. Decoding runs on
+    # threads, hashing on the whole stack at once.
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        loaded = list(executor.map(load_or_none, paths))
+
+    hashed = [
+        (path, pixels) for path, pixels in zip(paths, loaded) if pixels is not None
+    ]
+    if not hashed:
+        return [], np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint64)
+
+    small = np.stack([pixels[0] for _, pixels in hashed])
+    large = np.stack([pixels[1] for _, pixels in hashed])
+    return [path for path, _ in hashed], dhash(small), phash(large)
+
+
+def save_hashes(
+    folder: Path, paths: list[Path], dhashes: np.ndarray, phashes: np.ndarray
+) -> None:
+    np.savez(
+        folder / HASHES_NAME,
+        paths=np.array([path.relative_to(folder).as_posix() for path in paths]),
+        dhash=dhashes,
+        phash=phashes,
+    )
+
+
+def load_hashes(folder: Path) -> tuple[list[str], np.ndarray, np.ndarray]:
+    with np.load(folder / HASHES_NAME) as data:
+        return data["paths"].tolist(), data["dhash"], data["phash"]
+
+
+def close_pairs(hashes: np.ndarray, distance: int = DISTANCE) -> np.ndarray:
+    # (i, j) pairs of hashes at most distance bits apart, by multi-index
+    # hashing: split in distance + 1 chunks, two close hashes have at least
+    # one identical chunk, so only hashes sharing a chunk are compared
+    chunks = distance + 1
+    bits = 64 // chunks
+    pairs: set[tuple[int, int]] = set()
+
+    for chunk in range(chunks):
+        width = bits if chunk < chunks - 1 else 64 - bits * chunk
+        keys = (hashes >> np.uint64(bits * chunk)) & np.uint64((1 << width) - 1)
+        order = np.argsort(keys, kind="stable")
+        _, starts = np.unique(keys[order], return_index=True)
+
+        for bucket in np.split(order, starts[1:]):
+            if len(bucket) < 2:
+                continue
+            first, second = np.triu_indices(len(bucket), 1)
+            close = hamming(hashes[bucket[first]], hashes[bucket[second]]) <= distance
+            pairs.update(
+                zip(bucket[first][close].tolist(), bucket[second][close].tolist())
+            )
+
+    return np.array(sorted(pairs), dtype=np.int64).reshape(-1, 2)
+
+
+def clusters(hashes: np.ndarray, distance: int = DISTANCE) -> list[list[int]]:
+    # Groups of covers linked by close pairs, largest first
+    parents = list(range(len(hashes)))
+
+    def find(index: int) -> int:
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for first, second in close_pairs(hashes, distance):
+        parents[find(first)] = find(second)
+
+    groups: dict[int, list[int]] = {}
+    for index in range(len(hashes)):
+        groups.setdefault(find(index), []).append(index)
+
+    return sorted(
+        (group for group in groups.values() if len(group) > 1),
+        key=len,
+        reverse=True,
+    )
+
+
+def candidates(
+    hashes: np.ndarray, query_hash: int, distance: int = DISTANCE
+) -> np.ndarray:
+    # Indices of the hashes close to the query, to restrict a costlier search
+    return np.flatnonzero(hamming(hashes, query_hash) <= distance)
+
+
+def hash_image(path: Path) -> int:
+    # pHash of a single cover
+    _, large = load_cover(path)
+    return int(phash(large[None])[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find duplicate covers")
+    parser.add_argument("folder", type=Path, default=FOLDER, nargs="?")
+    parser.add_argument(
+        "--distance",
+        type=int,
+        default=DISTANCE,
+        help="Maximum number of different bits between duplicates",
+    )
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args()
+
+    folder = args.folder
+    if not folder.is_dir():
+        parser.error(f"{folder} is not a directory")
+
+    logging.basicConfig(level=logging.INFO)
+
+    paths, dhashes, phashes = hash_covers(find_covers(folder), args.workers)
+    save_hashes(folder, paths, dhashes, phashes)
+    logger.info("Hashed %d covers in %s", len(paths), folder)
+
+    for group in clusters(phashes, args.distance):
+        print("\n".join(str(paths[index]) for index in group))
+        print()
+
+
+if __name__ == "__main__":
+    main()
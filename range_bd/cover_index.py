@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import numpy as np
+
+from range_bd.manifest import file_hash
+
+INDEX_NAME = "covers"
+DTYPES = {"float16": np.float16, "float32": np.float32}
+# float16 halves the size of the index but its search is about ten times
+# slower: NumPy has no fast float16 matrix product
+DTYPE = "float32"
+TOP_K = 5
+# Rows converted to float32 at once when searching a float16 index
+CHUNK_SIZE = 8192
+
+
+def normalise(vectors: np.ndarray) -> np.ndarray:
+    # Unit rows, so that the cosine similarity is a dot product
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, np.finfo(np.float32).tiny)
+
+
+@dataclass
+class Fingerprint:
+    size: int
+    mtime: float
+    hash: str
+
+    @classmethod
+    def of(cls, path: Path, hash_: str | None = None) -> Fingerprint:
+        stat = path.stat()
+        return cls(stat.st_size, stat.st_mtime, hash_ or file_hash(path))
+
+
+@dataclass
+class CoverIndex:
+    # Feature vectors of the covers, one row per path, relative to the folder
+    vectors: np.ndarray
+    paths: list[str]
+    # Thumbnail of each row when it was indexed
+    fingerprints: list[Fingerprint]
+
+    @classmethod
+    def build(
+        cls,
+        vectors: np.ndarray,
+        paths: list[str],
+        fingerprints: list[Fingerprint],
+        dtype: str = DTYPE,
+    ) -> CoverIndex:
+        if not len(vectors) == len(paths) == len(fingerprints):
+            raise ValueError(f"{len(vectors)} vectors for {len(paths)} paths")
+        return cls(normalise(vectors).astype(DTYPES[dtype]), paths, fingerprints)
+
+    @staticmethod
+    def files(folder: Path) -> tuple[Path, Path]:
+        return folder / f"{INDEX_NAME}.npy", folder / f"{INDEX_NAME}.paths.json"
+
+    @classmethod
+    def exists(cls, folder: Path) -> bool:
+        return all(path.exists() for path in cls.files(folder))
+
+    def save(self, folder: Path) -> None:
+        # Written aside then renamed, so that a crash leaves the previous index
+        vectors_path, paths_path = self.files(folder)
+        tmp_vectors_path = vectors_path.with_stem(vectors_path.stem + "_TMP")
+        tmp_paths_path = paths_path.with_stem(paths_path.stem + "_TMP")
+
+        np.save(tmp_vectors_path, self.vectors)
+        table = [
+            {"path": path, **asdict(fingerprint)}
+            for path, fingerprint in zip(self.paths, self.fingerprints)
+        ]
+        tmp_paths_path.write_text(json.dumps(table, ensure_ascii=False), "utf-8")
+
+        os.replace(tmp_vectors_path, vectors_path)
+        os.replace(tmp_paths_path, paths_path)
+
+    @classmethod
+    def load(cls, folder: Path) -> CoverIndex:
+        # The vectors are memory-mapped: only the pages read by a search are
+        # loaded
+        vectors_path, paths_path = cls.files(folder)
+        vectors = np.load(vectors_path, mmap_mode="r")
+        table = json.loads(paths_path.read_text("utf-8"))
+        return cls(
+            vectors,
+            [row["path"] for row in table],
+            [Fingerprint(row["size"], row["mtime"], row["hash"]) for row in table],
+        )
+
+    def select(self, rows: list[int]) -> CoverIndex:
+        # Copy of the given rows, read from the memory map
+        return CoverIndex(
+            np.array(self.vectors[rows]),
+            [self.paths[row] for row in rows],
+            [self.fingerprints[row] for row in rows],
+        )
+
+    def extend(self, other: CoverIndex) -> CoverIndex:
+        if not other.paths:
+            return self
+        if not self.paths:
+            return other
+        return CoverIndex(
+            np.concatenate([self.vectors, other.vectors.astype(self.vectors.dtype)]),
+            self.paths + other.paths,
+            self.fingerprints + other.fingerprints,
+        )
+
+    def search(
+        self, vector: np.ndarray, k: int = TOP_K, rows: np.ndarray | None = None
+    ) -> list[tuple[str, float]]:
+        # Paths of the k most similar covers with their cosine similarity,
+        # best first, only among the given rows if any
+        if rows is None:
+            rows = np.arange(len(self.paths))
+        if not len(rows):
+            return []
+
+        query = normalise(vector).reshape(-1)
+        scores = np.empty(len(rows), dtype=np.float32)
+        for start in range(0, len(rows), CHUNK_SIZE):
+            chunk = self.vectors[rows[start : start + CHUNK_SIZE]]
+            scores[start : start + len(chunk)] = (
+                chunk.astype(np.float32, copy=False) @ query
+            )
+
+        k = min(k, len(scores))
+        best = np.argpartition(scores, -k)[-k:]
+        best = best[np.argsort(scores[best])[::-1]]
+        return [(self.paths[rows[index]], float(scores[index])) for index in best]
+
+
+def plan_update(
+    index: CoverIndex, folder: Path, images: list[Path]
+) -> tuple[list[int], list[tuple[Path, Fingerprint]]]:
+    # Rows of the index still valid, and the images to extract features from.
+    # Content is only hashed when the size or mtime changed: a touched but
+    # unchanged thumbnail keeps its row.
+    rows = {path: row for row, path in enumerate(index.paths)}
+    kept: list[int] = []
+    to_extract: list[tuple[Path, Fingerprint]] = []
+
+    for image in images:
+        relative_path = image.relative_to(folder).as_posix()
+        row = rows.get(relative_path)
+        stat = image.stat()
+        if row is not None:
+            fingerprint = index.fingerprints[row]
+            if (stat.st_size, stat.st_mtime) == (fingerprint.size, fingerprint.mtime):
+                kept.append(row)
+                continue
+
+        new_fingerprint = Fingerprint.of(image)
+        if row is not None and new_fingerprint.hash == index.fingerprints[row].hash:
+            index.fingerprints[row] = new_fingerprint
+            kept.append(row)
+        else:
+            to_extract.append((image, new_fingerprint))
+
+    return kept, to_extract
@@ -2,15 +2,32 @@ from __future__ import annotations
 
 import argparse
 import logging
+import os
 from pathlib import Path
+from typing import Iterator
 
+import numpy as np
 import torch
 from PIL import Image
+from torch.utils.data import DataLoader, Dataset
 from torchvision import models, transforms
 
+from range_bd.cover_hash import candidates, hash_image, load_hashes
+from range_bd.cover_index import (
+    DTYPE,
+    DTYPES,
+    TOP_K,
+    CoverIndex,
+    Fingerprint,
+    plan_update,
+)
+
 logger = logging.getLogger(__name__)
 
 FOLDER = Path(r"M:\Bédés\thumbnails")
+BATCH_SIZE = 32
+# Processes decoding and preprocessing images while the model runs
+WORKERS = min(4, os.cpu_count() or 1)
 
 
 def init() -> tuple[torch.nn.Module, transforms.Compose]:
@@ -31,16 +48,20 @@ def init() -> tuple[torch.nn.Module, transforms.Compose]:
     return model, preprocess
 
 
+def load_image(preprocess: transforms.Compose, image_path: Path) -> torch.Tensor:
+    image = Image.open(str(image_path)).convert("RGB")
+    return preprocess(image)
+
+
 def extract_features(
     model: torch.nn.Module, preprocess: transforms.Compose, image_path: Path
 ):
     logger.info("Extracting features from %s", image_path)
-    image = Image.open(str(image_path)).convert("RGB")
-    image = preprocess(image)
+    image = load_image(preprocess, image_path)
     image = image.unsqueeze(0)  # Ajouter une dimension de batch
 
     # Pas de calcul de gradient nécessaire
-    with torch.no_grad():
+    with torch.inference_mode():
         # Obtenir les caractéristiques de l'image
         features = model(image)
 
@@ -50,27 +71,209 @@ def extract_features(
 IMG_FILETYPES = {".png", ".jpg", ".gif"}
 
 
-def recurse(
-    model: torch.nn.Module,
-    preprocess: transforms.Compose,
-    top_path: Path,
-    features: list[torch.Tensor],
-):
+def find_images(top_path: Path) -> Iterator[Path]:
     for subpath in top_path.iterdir():
         if subpath.is_dir():
-            recurse(model, preprocess, subpath, features)
+            yield from find_images(subpath)
         elif subpath.suffix.lower() in IMG_FILETYPES:
-            try:
-                features_ = extract_features(model, preprocess, subpath)
-            except Exception as exc:
-                logger.exception(exc)
-            else:
-                features.append(features_)
+            yield subpath
+
+
+class CoverDataset(Dataset):
+    def __init__(self, paths: list[Path], preprocess: transforms.Compose):
+        self.paths = paths
+        self.preprocess = preprocess
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __getitem__(self, index: int) -> tuple[Path, torch.Tensor] | None:
+        path = self.paths[index]
+        try:
+            return path, load_image(self.preprocess, path)
+        except Exception as exc:
+            logger.exception(exc)
+            return None
+
+
+def collate(
+    items: list[tuple[Path, torch.Tensor] | None],
+) -> tuple[list[Path], torch.Tensor | None]:
+    # Images which could not be read are left out of the batch
+    loaded = [item for item in items if item is not None]
+    if not loaded:
+        return [], None
+    return [path for path, _ in loaded], torch.stack([image for _, image in loaded])
+
+
+def set_threads(workers: int, threads: int | None = None) -> None:
+    # Leave a core to each decoding worker, the rest goes to the model
+    if threads is None:
+        threads = max(1, (os.cpu_count() or 1) - workers)
+    torch.set_num_threads(threads)
+    logger.info("Running the model on %d threads", threads)
+
+
+def extract_batches(
+    model: torch.nn.Module,
+    preprocess: transforms.Compose,
+    paths: list[Path],
+    batch_size: int = BATCH_SIZE,
+    workers: int = WORKERS,
+) -> Iterator[tuple[list[Path], torch.Tensor]]:
+    # Images are decoded by worker processes while the model runs on the
+    # previous batch. In eval mode every image is computed independently, so
+    # its features are those of extract_features, up to float rounding.
+    loader = DataLoader(
+        CoverDataset(paths, preprocess),
+        batch_size=batch_size,
+        num_workers=workers,
+        collate_fn=collate,
+    )
+
+    with torch.inference_mode():
+        for batch_paths, images in loader:
+            if images is None:
+                continue
+            logger.info(
+                "Extracting features from %d images, up to %s",
+                len(batch_paths),
+                batch_paths[-1],
+            )
+            yield batch_paths, model(images)
+
+
+def extract_index(
+    model: torch.nn.Module,
+    preprocess: transforms.Compose,
+    folder: Path,
+    images: list[tuple[Path, Fingerprint]],
+    batch_size: int = BATCH_SIZE,
+    workers: int = WORKERS,
+    dtype: str = DTYPE,
+) -> CoverIndex:
+    fingerprints = dict(images)
+    paths: list[str] = []
+    vectors: list[np.ndarray] = []
+    for batch_paths, features in extract_batches(
+        model, preprocess, list(fingerprints), batch_size, workers
+    ):
+        paths.extend(path.relative_to(folder).as_posix() for path in batch_paths)
+        vectors.append(features.numpy())
+
+    if not vectors:
+        return CoverIndex.build(np.empty((0, 0), dtype=np.float32), [], [], dtype)
+    return CoverIndex.build(
+        np.concatenate(vectors),
+        paths,
+        [fingerprints[folder / path] for path in paths],
+        dtype,
+    )
+
+
+def update_index(
+    model: torch.nn.Module,
+    preprocess: transforms.Compose,
+    folder: Path,
+    batch_size: int = BATCH_SIZE,
+    workers: int = WORKERS,
+    dtype: str = DTYPE,
+    rebuild: bool = False,
+) -> CoverIndex:
+    # Only new and changed thumbnails go through the model, deleted ones are
+    # dropped from the index
+    images = list(find_images(folder))
+    if rebuild or not CoverIndex.exists(folder):
+        index = extract_index(
+            model,
+            preprocess,
+            folder,
+            [(image, Fingerprint.of(image)) for image in images],
+            batch_size,
+            workers,
+            dtype,
+        )
+        index.save(folder)
+        return index
+
+    index = CoverIndex.load(folder)
+    kept, to_extract = plan_update(index, folder, images)
+    logger.info(
+        "%d covers unchanged, %d to index, %d removed",
+        len(kept),
+        len(to_extract),
+        len(index.paths) - len(kept),
+    )
+
+    new_index = index.select(kept).extend(
+        extract_index(model, preprocess, folder, to_extract, batch_size, workers, dtype)
+    )
+    new_index.vectors = new_index.vectors.astype(DTYPES[dtype], copy=False)
+    # Release the memory map before replacing the file
+    del index
+    new_index.save(folder)
+    return new_index
+
+
+def query(
+    model: torch.nn.Module,
+    preprocess: transforms.Compose,
+    index: CoverIndex,
+    folder: Path,
+    image_path: Path,
+    k: int = TOP_K,
+    distance: int | None = None,
+) -> list[tuple[Path, float]]:
+    # Covers of the index closest to the image, with their cosine similarity.
+    # With a distance, only the covers whose perceptual hash is that close are
+    # searched.
+    rows = None
+    if distance is not None:
+        paths, _, phashes = load_hashes(folder)
+        close = {
+            paths[row] for row in candidates(phashes, hash_image(image_path), distance)
+        }
+        rows = np.array(
+            [row for row, path in enumerate(index.paths) if path in close],
+            dtype=np.int64,
+        )
+
+    features = extract_features(model, preprocess, image_path)
+    return [
+        (folder / path, score)
+        for path, score in index.search(features.numpy(), k, rows)
+    ]
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("folder", type=Path, default=FOLDER, nargs="?")
+    parser.add_argument(
+        "--query", type=Path, help="Find the covers closest to this image"
+    )
+    parser.add_argument("-k", type=int, default=TOP_K, help="Covers to find")
+    parser.add_argument(
+        "--prefilter",
+        type=int,
+        default=None,
+        metavar="DISTANCE",
+        help="Only search the covers whose perceptual hash, computed by "
+        "cover_hash, differs by at most this many bits",
+    )
+    parser.add_argument("--dtype", choices=DTYPES, default=DTYPE)
+    parser.add_argument(
+        "--rebuild", action="store_true", help="Index every cover again"
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--workers", type=int, default=WORKERS, help="Image decoding processes"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Model threads, by default one per core not used by the workers",
+    )
     args = parser.parse_args()
 
     folder = args.folder
@@ -79,15 +282,27 @@ def main():
 
     logging.basicConfig(level=logging.INFO)
 
+    set_threads(args.workers, args.threads)
     model, preprocess = init()
-    features_list = []
-
-    recurse(model, preprocess, folder, features_list)
 
-    # features_list contient maintenant les caractéristiques des images du répertoire A
+    if args.query:
+        index = CoverIndex.load(folder)
+        for path, score in query(
+            model, preprocess, index, folder, args.query, args.k, args.prefilter
+        ):
+            print(f"{score:.3f} {path}")
+        return
 
-    with open(folder / "features.json", "wb") as f:
-        torch.save(features_list, f)
+    index = update_index(
+        model,
+        preprocess,
+        folder,
+        args.batch_size,
+        args.workers,
+        args.dtype,
+        args.rebuild,
+    )
+    logger.info("Indexed %d covers in %s", len(index.paths), folder)
 
 
 if __name__ == "__main__":
@@ -1,18 +1,31 @@
 from __future__ import annotations
 
+import argparse
 import json
 import logging
+import os
 import platform
 import subprocess
+import threading
 import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import suppress
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
-from zipfile import ZipFile
+from queue import Empty, Queue
+from typing import Callable, Optional
+from zipfile import BadZipFile, ZipFile
 
 import cv2
 import numpy as np
 from bs4 import BeautifulSoup
+from PIL import Image
+from selenium.common.exceptions import (
+    NoSuchElementException,
+    StaleElementReferenceException,
+    TimeoutException,
+)
 from selenium.webdriver import Firefox, FirefoxOptions
 from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.common.by import By
@@ -20,6 +33,9 @@ from selenium.webdriver.common.keys import Keys
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 
+from range_bd import sanitizer
+from range_bd.manifest import CAPTURES_NAME, Capture, CaptureManifest
+
 BASE_URL = "https://www.izneo.com"
 LOGIN_URL = "https://www.izneo.com/fr/login"
 
@@ -30,8 +46,45 @@ URLS = []
 BEDE_FOLDER = Path.home() / "Bédés"
 BEDE_FOLDER.mkdir(exist_ok=True)
 
-TMP_FOLDER = BEDE_FOLDER / "izneo_temp"
-TMP_FOLDER.mkdir(exist_ok=True)
+# Threads cropping and encoding pages, OpenCV releases the GIL
+ENCODE_WORKERS = os.cpu_count() or 1
+
+CURRENT_PAGE_ID = "iz_OpenSliderCurrent"
+LAST_PAGE_ID = "iz_OpenSliderLast"
+# Whether every displayed image of the reader has been decoded
+IMAGES_LOADED_SCRIPT = """
+return Array.from(document.images)
+    .filter(image => image.offsetParent !== null)
+    .every(image => image.complete && image.naturalWidth > 0);
+"""
+# A page turn may take up to PAGE_TIMEOUT_FACTOR times the average one,
+# within these bounds
+PAGE_TIMEOUT_MIN = 2.0
+PAGE_TIMEOUT_MAX = 30.0
+PAGE_TIMEOUT_FACTOR = 4
+POLL_FREQUENCY = 0.05
+# Screenshots identical to the previous page are taken again this many times
+CAPTURE_RETRIES = 3
+# Time for the header and footer to disappear after zooming, at most
+ZOOM_TIMEOUT = 5.0
+# Move the reader's page slider, false when there is no slider
+SLIDER_SCRIPT = """
+const slider = document.querySelector("input[type=range]");
+if (!slider) {
+    return false;
+}
+slider.value = arguments[0];
+slider.dispatchEvent(new Event("input", {bubbles: true}));
+slider.dispatchEvent(new Event("change", {bubbles: true}));
+return true;
+"""
+
+# Browsers downloading albums at the same time
+SESSIONS = 1
+# Page loads and turns per second, for all the browsers together
+RATE_LIMIT = 4.0
+# A failed album is queued again until it has been tried this many times
+ALBUM_ATTEMPTS = 2
 
 
 def get_all_tomes_from_series(driver: Firefox, url: str) -> list[str]:
@@ -56,6 +109,10 @@ def login(driver: Firefox, username: str, password: str):
     driver.find_element(By.CLASS_NAME, "button").click()
 
 
+def get_tome_id(url: str) -> str:
+    return url.split("/")[-1].rsplit("-", maxsplit=1)[1]
+
+
 def get_details_from_url(
     driver: Firefox, url: str
 ) -> tuple[list[str], str, str, str, Optional[str]]:
@@ -80,7 +137,7 @@ def get_details_from_url(
     tome_div = soup.find("div", class_="text text--md text--bold album-to-serie")
     tome_span = tome_div.find("span")
     tome = tome_span.text.strip()
-    tome_id = url.split("/")[-1].rsplit("-", maxsplit=1)[1]
+    tome_id = get_tome_id(url)
 
     category_div = soup.find("div", class_="for_genres items")
     categories: list[str] = category_div.find("a").text.strip().split(" / ")
@@ -94,7 +151,154 @@ def get_details_from_url(
     return categories, series, tome, tome_id, number
 
 
-def download(driver: Firefox, url: str) -> Path | None:
+class PageTimer:
+    # Running average of the page turns, to derive their timeout
+
+    def __init__(self) -> None:
+        self.average: float | None = None
+
+    def observe(self, seconds: float) -> None:
+        if self.average is None:
+            self.average = seconds
+        else:
+            self.average = 0.8 * self.average + 0.2 * seconds
+
+    @property
+    def timeout(self) -> float:
+        if self.average is None:
+            return PAGE_TIMEOUT_MAX
+        return min(
+            PAGE_TIMEOUT_MAX, max(PAGE_TIMEOUT_MIN, PAGE_TIMEOUT_FACTOR * self.average)
+        )
+
+    @property
+    def retry_delay(self) -> float:
+        return self.average or POLL_FREQUENCY
+
+
+def read_page(driver: Firefox, element_id: str) -> int | None:
+    try:
+        return int(driver.find_element(By.ID, element_id).text.strip())
+    except (NoSuchElementException, StaleElementReferenceException, ValueError):
+        return None
+
+
+def page_ready(page: int, exact: bool = False) -> Callable[[Firefox], bool]:
+    def ready(driver: Firefox) -> bool:
+        current_page = read_page(driver, CURRENT_PAGE_ID)
+        return (
+            current_page is not None
+            and (current_page == page if exact else current_page >= page)
+            and driver.execute_script(IMAGES_LOADED_SCRIPT)
+        )
+
+    return ready
+
+
+def wait_for_page(
+    driver: Firefox, page: int, timer: PageTimer, exact: bool = False
+) -> None:
+    # Wait for the counter to reach the page and its image to be loaded
+    start = time.perf_counter()
+    try:
+        WebDriverWait(driver, timer.timeout, poll_frequency=POLL_FREQUENCY).until(
+            page_ready(page, exact)
+        )
+    except TimeoutException:
+        logging.warning("Page %d not loaded after %.1fs", page, timer.timeout)
+    timer.observe(time.perf_counter() - start)
+
+
+def go_to_page(
+    driver: Firefox,
+    page: int,
+    current_page: int,
+    arrow: str,
+    back_arrow: str,
+    timer: PageTimer,
+) -> None:
+    # Jump to the page with the reader's slider, or turn pages one by one
+    # when there is none
+    if page == current_page:
+        return
+
+    logging.info("Current page: %d. Going to page #%d", current_page, page)
+    if not driver.execute_script(SLIDER_SCRIPT, page):
+        actions = ActionChains(driver)
+        for _ in range(abs(page - current_page)):
+            actions.send_keys(arrow if page > current_page else back_arrow)
+        actions.perform()
+
+    wait_for_page(driver, page, timer, exact=True)
+
+
+def wait_until_stable(driver: Firefox, timeout: float) -> bytes:
+    # Wait for two identical screenshots in a row, e.g. for an animation to end
+    deadline = time.perf_counter() + timeout
+    previous = driver.get_screenshot_as_png()
+    while time.perf_counter() < deadline:
+        time.sleep(POLL_FREQUENCY)
+        screenshot = driver.get_screenshot_as_png()
+        if screenshot == previous:
+            break
+        previous = screenshot
+    return previous
+
+
+def capture(driver: Firefox, previous: bytes | None, timer: PageTimer) -> bytes:
+    # Screenshot of the page, taken again while it is the one of the previous
+    # page: the counter can change before the page is drawn
+    screenshot = driver.get_screenshot_as_png()
+    for _ in range(CAPTURE_RETRIES):
+        if screenshot != previous:
+            break
+        time.sleep(timer.retry_delay)
+        screenshot = driver.get_screenshot_as_png()
+    else:
+        if screenshot == previous:
+            logging.warning("Page unchanged after %d retries", CAPTURE_RETRIES)
+    return screenshot
+
+
+class RateLimiter:
+    # At most rate calls to wait per second, by all the threads together
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def is_captured(entry: Capture | None) -> bool:
+    # Whether a previous run captured every page of the album
+    return entry is not None and entry.finished and entry.output.exists()
+
+
+def download(
+    driver: Firefox,
+    url: str,
+    limiter: RateLimiter | None = None,
+    resize: bool = False,
+    captures: CaptureManifest | None = None,
+    stop: threading.Event | None = None,
+) -> Path | None:
+    # Capture the album, or its first pages when stop is set on the way
+    limiter = limiter or RateLimiter(0)
+
+    entry = captures.get(get_tome_id(url)) if captures is not None else None
+    if entry is not None and is_captured(entry):
+        logging.info("Already captured in %s. Skipping", entry.output)
+        return entry.output
+
+    limiter.wait()
     (
         categories,
         series,
@@ -112,31 +316,22 @@ def download(driver: Firefox, url: str) -> Path | None:
         arrow = Keys.ARROW_RIGHT
         back_arrow = Keys.ARROW_LEFT
 
-    path = Path(f"{series}/{tome} - {tome_id}")
-    path.mkdir(parents=True, exist_ok=True)
-
     actions = ActionChains(driver)
 
+    limiter.wait()
     driver.get(reader_url)
     logging.info("Downloading: %s", reader_url)
     # driver.fullscreen_window()
 
     # Wait for div iz_OpenSliderLast to appears
     wait = WebDriverWait(driver, 20)
-    wait.until(EC.presence_of_element_located((By.ID, "iz_OpenSliderLast")))
+    wait.until(EC.presence_of_element_located((By.ID, LAST_PAGE_ID)))
 
     # Catch value of iz_OpenSliderLast
     soup = BeautifulSoup(driver.page_source, "html.parser")
-    current_page = soup.find(id="iz_OpenSliderCurrent").text.strip()
-
-    if current_page != "1":
-        logging.info("Current page: %s. Back to page #1", current_page)
-        for _ in range(int(current_page) - 1):
-            actions.send_keys(back_arrow)
-            time.sleep(0.2)
-        current_page = "1"
+    current_page = soup.find(id=CURRENT_PAGE_ID).text.strip()
 
-    last_page = soup.find(id="iz_OpenSliderLast").text
+    last_page = soup.find(id=LAST_PAGE_ID).text
     if last_page == "10":
         # Assume not paid
         logging.info("Not paid. Skipping")
@@ -146,34 +341,59 @@ def download(driver: Firefox, url: str) -> Path | None:
     number_length = len(last_page)
     number_of_pages = int(last_page)
 
+    cbz_file_path = get_cbz_path(series, number)
+
+    # Resume after the pages of a previous run, as long as they are readable
+    start = 0
+    if entry is not None and entry.output == cbz_file_path:
+        start = min(entry.captured, count_pages(cbz_file_path))
+        if start:
+            logging.info("Resuming after page %d", start)
+
+    timer = PageTimer()
+    go_to_page(driver, start + 1, int(current_page), arrow, back_arrow, timer)
+
     # Zoom in
     actions.send_keys("w")
     actions.perform()
 
     # Wait for footer/header to disappear
-    time.sleep(5)
-
-    for index in range(number_of_pages):
-        time.sleep(2)
-        driver.save_screenshot(
-            path
-            / f"{series} {('#' + number + ' - ') if number is not None else '- '}{str(index).zfill(number_length)}.png"
-        )
-
-        # press LEFT arrow
-        actions.send_keys(arrow)
-        actions.perform()
-    # move_images(path, BEDE_FOLDER)
-
-    create_cbz(path, series, number)
-
-    return path
+    wait_until_stable(driver, ZOOM_TIMEOUT)
 
+    logging.info("Creating cbz file %s", cbz_file_path)
 
-def move_images(path: Path, new_path: Path) -> None:
-    for image in path.glob("*.png"):
-        image.rename(new_path / image.name)
-    path.rmdir()
+    def record(written: int) -> None:
+        # Progress is saved as pages are written, so that a run interrupted
+        # in any way resumes after them
+        if captures is not None:
+            captures.record(
+                Capture(tome_id, start + written, number_of_pages, cbz_file_path)
+            )
+
+    # Pages are cropped and encoded in the background while the next ones are
+    # captured. Pages added are written when the packer closes, even on
+    # failure.
+    screenshot: bytes | None = None
+    with PagePacker(cbz_file_path, resize, append=start > 0, on_write=record) as packer:
+        for index in range(start, number_of_pages):
+            if stop is not None and stop.is_set():
+                logging.info("%s: stopped before page %d", tome_id, index + 1)
+                break
+
+            wait_for_page(driver, index + 1, timer)
+            screenshot = capture(driver, screenshot, timer)
+            packer.add(
+                f"{series} {('#' + number + ' - ') if number is not None else '- '}{str(index).zfill(number_length)}.png",
+                screenshot,
+            )
+            logging.info("%s: page %d/%d", tome_id, index + 1, number_of_pages)
+
+            # press LEFT arrow
+            limiter.wait()
+            actions.send_keys(arrow)
+            actions.perform()
+
+    return cbz_file_path
 
 
 @dataclass
@@ -184,49 +404,152 @@ class Crop:
     max_y_nonzero: int
 
 
+def find_crop(image: np.ndarray) -> Crop:
+    # Bounding box of the non black pixels, the max bounds excluded. Reducing
+    # each axis avoids the index arrays of np.nonzero over the whole screen.
+    mask = image.any(axis=2)
+    rows = np.flatnonzero(mask.any(axis=1))
+    columns = np.flatnonzero(mask.any(axis=0))
+    if not len(rows):
+        return Crop(0, image.shape[1], 0, image.shape[0])
+
+    return Crop(columns[0], columns[-1] + 1, rows[0], rows[-1] + 1)
+
+
+def crop_image(image: np.ndarray, crop: Crop) -> np.ndarray:
+    # A view on the image, nothing is copied
+    return image[
+        crop.min_y_nonzero : crop.max_y_nonzero, crop.min_x_nonzero : crop.max_x_nonzero
+    ]
+
+
 def crop_edges(image_path: Path, crop: Crop | None) -> Crop:
     logging.info("Cropping edges on %s", image_path)
 
     image = cv2.imread(str(image_path))
 
     if not crop:
-        y_nonzero, x_nonzero, _ = np.nonzero(image)
-        crop = Crop(
-            np.min(x_nonzero), np.max(x_nonzero), np.min(y_nonzero), np.max(y_nonzero)
-        )
+        crop = find_crop(image)
 
-    cropped_image = image[
-        crop.min_y_nonzero : crop.max_y_nonzero, crop.min_x_nonzero : crop.max_x_nonzero
-    ]
-
-    cv2.imwrite(str(image_path), cropped_image)
+    cv2.imwrite(str(image_path), crop_image(image, crop))
 
     return crop
 
 
-def create_cbz(download_path: Path, series: str, number: Optional[str]) -> None:
+def decode(png: bytes) -> np.ndarray:
+    return cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_COLOR)
+
+
+def encode_page(png: bytes, crop: Crop, resize: bool = False) -> bytes:
+    # Cropped page, resized and encoded like the sanitizer does if asked
+    image = crop_image(decode(png), crop)
+    if resize:
+        rgb = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        return sanitizer.resize_jpg(rgb).getvalue()
+
+    _, data = cv2.imencode(".png", image)
+    return data.tobytes()
+
+
+class PagePacker:
+    # Crop, encode and write pages to a cbz in the background, in the order
+    # they are added. Every page is cropped like the first one. Only a few
+    # pages are in flight at once to bound memory usage. on_write is called
+    # with the number of pages written so far after writing some.
+
+    def __init__(
+        self,
+        cbz_path: Path,
+        resize: bool = False,
+        workers: int = ENCODE_WORKERS,
+        append: bool = False,
+        on_write: Callable[[int], None] | None = None,
+    ) -> None:
+        self.resize = resize
+        self.workers = workers
+        self.on_write = on_write
+        self.written = 0
+        self.crop: Crop | None = None
+        self.pending: deque[tuple[str, Future[bytes]]] = deque()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.cbz_file = ZipFile(cbz_path, "a" if append else "w")
+
+    def __enter__(self) -> PagePacker:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def add(self, name: str, png: bytes) -> None:
+        if self.crop is None:
+            self.crop = find_crop(decode(png))
+        if self.resize:
+            name = sanitizer.page_name(name)
+
+        future = self.executor.submit(encode_page, png, self.crop, self.resize)
+        self.pending.append((name, future))
+        self.flush(2 * self.workers - 1)
+
+    def flush(self, keep: int = 0) -> None:
+        # Write the encoded pages, waiting for them while more than keep are
+        # pending
+        written = self.written
+        while self.pending and (len(self.pending) > keep or self.pending[0][1].done()):
+            name, future = self.pending.popleft()
+            self.cbz_file.writestr(name, future.result())
+            self.written += 1
+
+        if self.on_write is not None and self.written > written:
+            self.on_write(self.written)
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            self.cbz_file.close()
+
+
+def count_pages(cbz_path: Path) -> int:
+    # Pages of an archive, none when it is missing or was left unfinished
+    try:
+        with ZipFile(cbz_path) as cbz_file:
+            return len(cbz_file.namelist())
+    except (OSError, BadZipFile):
+        return 0
+
+
+def get_cbz_path(series: str, number: Optional[str]) -> Path:
     series_folder = BEDE_FOLDER / series
     series_folder.mkdir(parents=True, exist_ok=True)
-    cbz_file_path = series_folder / f"{series} #{number}.zip"
+    return series_folder / f"{series} #{number}.zip"
+
 
-    crop: Crop | None = None
+def create_cbz(
+    download_path: Path, series: str, number: Optional[str], resize: bool = False
+) -> None:
+    cbz_file_path = get_cbz_path(series, number)
 
     logging.info("Creating cbz file %s", cbz_file_path)
 
-    with ZipFile(cbz_file_path, "w") as cbz_file:
-        for image in download_path.glob("*.png"):
-            crop = crop_edges(image, crop)
+    with PagePacker(cbz_file_path, resize) as packer:
+        for image in sorted(download_path.glob("*.png")):
+            packer.add(image.name, image.read_bytes())
 
-            cbz_file.write(str(image), image.name)
 
+class Progress:
+    def __init__(self, total: int) -> None:
+        self.total = total
+        self.finished = 0
+        self.lock = threading.Lock()
 
-def main() -> None:
-    logging.basicConfig(level=logging.INFO)
+    def report(self, url: str, status: str) -> None:
+        with self.lock:
+            self.finished += 1
+            logging.info("[%d/%d] %s: %s", self.finished, self.total, url, status)
 
-    credentials = json.load((Path(__file__).parent / "credentials.json").open())
-    username = credentials["importer"]["username"]
-    password = credentials["importer"]["password"]
 
+def new_driver(username: str, password: str) -> Firefox:
     options = FirefoxOptions()
 
     options.add_argument("-headless")
@@ -235,19 +558,142 @@ def main() -> None:
     options.add_argument("--disable-gpu")
 
     driver = Firefox(options=options)
-
-    with driver:
+    try:
         login(driver, username, password)
-
         driver.set_window_size(4000, 4000)
+    except Exception:
+        driver.quit()
+        raise
+
+    return driver
+
+
+def run_session(
+    index: int,
+    username: str,
+    password: str,
+    urls: Queue[tuple[str, int]],
+    limiter: RateLimiter,
+    progress: Progress,
+    stop: threading.Event,
+    resize: bool = False,
+    captures: CaptureManifest | None = None,
+) -> None:
+    # Download albums from the queue until it is empty or stop is set. A
+    # failure only costs the album and the browser it happened in: the
+    # session starts a new browser and the album is queued again.
+    driver: Firefox | None = None
+    try:
+        while not stop.is_set():
+            try:
+                url, attempt = urls.get_nowait()
+            except Empty:
+                return
+
+            try:
+                if driver is None:
+                    driver = new_driver(username, password)
+                path = download(driver, url, limiter, resize, captures, stop)
+            except Exception:
+                logging.exception("Session %d failed on %s", index, url)
+                if driver is not None:
+                    with suppress(Exception):
+                        driver.quit()
+                    driver = None
+
+                if stop.is_set():
+                    progress.report(url, "stopped")
+                elif attempt + 1 < ALBUM_ATTEMPTS:
+                    urls.put((url, attempt + 1))
+                else:
+                    progress.report(url, "failed")
+            else:
+                if path is None:
+                    progress.report(url, "skipped")
+                else:
+                    progress.report(url, "stopped" if stop.is_set() else "done")
+    finally:
+        if driver is not None:
+            driver.quit()
+
+
+def drain(queue: Queue) -> None:
+    with suppress(Empty):
+        while True:
+            queue.get_nowait()
 
-        urls = URLS
 
-        for base_series_url in BASE_SERIES_URLS:
-            urls.extend(get_all_tomes_from_series(driver, base_series_url))
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--sessions", type=int, default=SESSIONS, help="Browsers run at once"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=RATE_LIMIT,
+        help="Page loads and turns per second, for all the browsers together",
+    )
+    parser.add_argument(
+        "--resize",
+        action="store_true",
+        help="Resize and encode pages as the sanitizer does instead of PNG",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    credentials = json.load((Path(__file__).parent / "credentials.json").open())
+    username = credentials["importer"]["username"]
+    password = credentials["importer"]["password"]
 
-        for url in URLS:
-            download(driver, url)
+    urls = list(URLS)
+
+    if BASE_SERIES_URLS:
+        with new_driver(username, password) as driver:
+            for base_series_url in BASE_SERIES_URLS:
+                urls.extend(get_all_tomes_from_series(driver, base_series_url))
+
+    queue: Queue[tuple[str, int]] = Queue()
+    limiter = RateLimiter(args.rate)
+    stop = threading.Event()
+    with (
+        CaptureManifest(BEDE_FOLDER / CAPTURES_NAME) as captures,
+        ThreadPoolExecutor(max_workers=args.sessions) as executor,
+    ):
+        # Albums finished by a previous run are left out before any browser
+        # is started for them
+        urls = [url for url in urls if not is_captured(captures.get(get_tome_id(url)))]
+        logging.info("%d albums to capture", len(urls))
+        for url in urls:
+            queue.put((url, 0))
+
+        progress = Progress(len(urls))
+        sessions = [
+            executor.submit(
+                run_session,
+                index,
+                username,
+                password,
+                queue,
+                limiter,
+                progress,
+                stop,
+                args.resize,
+                captures,
+            )
+            for index in range(min(args.sessions, len(urls)))
+        ]
+        try:
+            wait(sessions)
+        except KeyboardInterrupt:
+            # The sessions finish the page they are on, then leaving the
+            # executor waits for them, before the manifest they record their
+            # progress to is closed
+            logging.warning("Interrupted, stopping the sessions")
+            stop.set()
+            drain(queue)
+            raise
 
 
 if __name__ == "__main__":
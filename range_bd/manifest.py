@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+import sqlite3
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+logger = logging.getLogger("Sanitizer")
+
+MANIFEST_NAME = "manifest.sqlite"
+
+PENDING = "pending"
+SUCCESS = "success"
+FAILURE = "failure"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    path TEXT NOT NULL,
+    completed INTEGER NOT NULL,
+    action TEXT,
+    status TEXT NOT NULL,
+    output TEXT
+);
+CREATE INDEX IF NOT EXISTS files_path ON files (path, size, mtime);
+"""
+
+
+@dataclass
+class Entry:
+    hash: str
+    size: int
+    mtime: float
+    path: Path
+    # Number of sanitizer actions already applied to this content
+    completed: int
+    action: str | None
+    status: str
+    output: Path | None
+
+
+def file_hash(path: Path) -> str:
+    with path.open("rb") as file_:
+        return hashlib.file_digest(file_, "sha256").hexdigest()
+
+
+class Manifest:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        # Several sanitizer workers write to the manifest at the same time
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.executescript(SCHEMA)
+
+    def __enter__(self) -> Manifest:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def clear(self) -> None:
+        with self.connection:
+            self.connection.execute("DELETE FROM files")
+
+    def _entry(self, row: tuple | None) -> Entry | None:
+        if row is None:
+            return None
+
+        hash_, size, mtime, path, completed, action, status, output = row
+        return Entry(
+            hash_,
+            size,
+            mtime,
+            Path(path),
+            completed,
+            action,
+            status,
+            Path(output) if output is not None else None,
+        )
+
+    def lookup(self, path: Path) -> tuple[str, Entry | None]:
+        # Return the content hash of path and its entry if the content is known.
+        # An unchanged path, size and mtime avoids reading the whole file again.
+        # Paths are stored resolved, whatever the current directory.
+        path = path.resolve()
+        stat = path.stat()
+
+        row = self.connection.execute(
+            "SELECT * FROM files WHERE path = ? AND size = ? AND mtime = ?",
+            (str(path), stat.st_size, stat.st_mtime),
+        ).fetchone()
+        if row is not None:
+            entry = self._entry(row)
+            assert entry is not None
+            return entry.hash, entry
+
+        hash_ = file_hash(path)
+        row = self.connection.execute(
+            "SELECT * FROM files WHERE hash = ? AND size = ?",
+            (hash_, stat.st_size),
+        ).fetchone()
+        return hash_, self._entry(row)
+
+    def record(
+        self,
+        path: Path,
+        completed: int,
+        action: str | None,
+        status: str,
+        output: Path | None = None,
+        hash_: str | None = None,
+    ) -> None:
+        path = path.resolve()
+        if output is not None:
+            output = output.resolve()
+        stat = path.stat()
+        if hash_ is None:
+            hash_ = file_hash(path)
+
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    hash_,
+                    stat.st_size,
+                    stat.st_mtime,
+                    str(path),
+                    completed,
+                    action,
+                    status,
+                    str(output) if output is not None else None,
+                ),
+            )
+
+
+CAPTURES_NAME = "captures.sqlite"
+
+CAPTURES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS captures (
+    tome_id TEXT PRIMARY KEY,
+    captured INTEGER NOT NULL,
+    pages INTEGER NOT NULL,
+    output TEXT NOT NULL
+);
+"""
+
+
+@dataclass
+class Capture:
+    tome_id: str
+    # Number of pages already written to output
+    captured: int
+    pages: int
+    output: Path
+
+    @property
+    def finished(self) -> bool:
+        return self.captured >= self.pages
+
+
+class CaptureManifest:
+    # Importer progress per album, shared by its browser sessions
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.connection.executescript(CAPTURES_SCHEMA)
+
+    def __enter__(self) -> CaptureManifest:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def get(self, tome_id: str) -> Capture | None:
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM captures WHERE tome_id = ?", (tome_id,)
+            ).fetchone()
+        if row is None:
+            return None
+
+        tome_id, captured, pages, output = row
+        return Capture(tome_id, captured, pages, Path(output))
+
+    def record(self, capture: Capture) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO captures VALUES (?, ?, ?, ?)",
+                (capture.tome_id, capture.captured, capture.pages, str(capture.output)),
+            )
@@ -1,20 +1,30 @@
 import argparse
-from pathlib import Path
+import glob
 import re
+import shutil
 import time
-
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from io import BytesIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
 from zipfile import ZipFile
-import subprocess
-import glob
+
 import send2trash
+from PIL import Image
 
+from range_bd.sanitizer import rasterise
 
 BDS = []
 BD_FOLDER = Path(r"D:\Bédés")
 FILENAME_PATTERN = re.compile(r"(.*)_Page\.pdf-\d+\.(?:png|jpg)")
 MAX_PER_RUN = 10
-DPI = 300
-MAX_HEIGHT = 4000
+JPG_QUALITY = 90
+# PDFs converted at the same time
+WORKERS = 2
+# Pages of a PDF encoded as JPEG at the same time
+ENCODE_WORKERS = 4
+# Pages are rasterised in memory when possible
+SCRATCH_FOLDER = Path("/dev/shm") if Path("/dev/shm").is_dir() else None
 
 
 def compress(bd_path: Path, output_folder: Path | None = None) -> list[Path]:
@@ -38,22 +48,75 @@ def compress(bd_path: Path, output_folder: Path | None = None) -> list[Path]:
     return images
 
 
-def convert_to_img(pdf_file: Path) -> Path:
-    print(f"To IMG: {pdf_file}")
-    subprocess.run(
-        [
-            "pdftoppm",
-            "-scale-to",
-            str(MAX_HEIGHT),
-            "-r",
-            str(DPI),
-            "-png",
-            str(pdf_file),
-            str(pdf_file.with_stem(pdf_file.stem + "_Page")),
-        ],
-        check=True,
+def to_jpeg(image_path: Path) -> bytes:
+    buffer = BytesIO()
+    with Image.open(image_path) as image:
+        image.convert("RGB").save(
+            buffer, format="JPEG", optimize=True, quality=JPG_QUALITY
+        )
+    image_path.unlink()
+    return buffer.getvalue()
+
+
+def convert_pdf(
+    pdf_file: Path,
+    output_folder: Path | None = None,
+    scratch_folder: Path | None = SCRATCH_FOLDER,
+) -> Path:
+    # Rasterise in a scratch folder and write the pages as JPEG in the CBZ,
+    # named as compress names them
+    cbz_file_path = ((output_folder or pdf_file.parent) / pdf_file.stem).with_suffix(
+        ".zip"
     )
-    return pdf_file
+    if cbz_file_path.exists():
+        print(f"CBZ already exists: {cbz_file_path}")
+        return cbz_file_path
+
+    print(f"To CBZ: {cbz_file_path}")
+    # Not a book suffix, so that the sanitizer leaves the unfinished file alone
+    tmp_path = cbz_file_path.with_name(cbz_file_path.name + ".part")
+    # Pages of a range are encoded in parallel, as sanitizer.write_pages does
+    try:
+        with (
+            TemporaryDirectory(dir=scratch_folder) as tmp_dir,
+            ThreadPoolExecutor(max_workers=ENCODE_WORKERS) as executor,
+            ZipFile(tmp_path, "w") as cbz_file,
+        ):
+            for batch in rasterise(pdf_file, Path(tmp_dir)):
+                for image_path, data in zip(batch, executor.map(to_jpeg, batch)):
+                    number = image_path.stem.rsplit("-", maxsplit=1)[1]
+                    cbz_file.writestr(f"{pdf_file.stem}_Page.pdf-{number}.jpg", data)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    tmp_path.rename(cbz_file_path)
+
+    return cbz_file_path
+
+
+def convert_all(
+    pdf_files: list[Path],
+    output_folder: Path | None = None,
+    workers: int = WORKERS,
+    scratch_folder: Path | None = SCRATCH_FOLDER,
+) -> list[Path]:
+    # Return the PDFs successfully converted
+    converted: list[Path] = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(convert_pdf, pdf_file, output_folder, scratch_folder): (
+                pdf_file
+            )
+            for pdf_file in pdf_files
+        }
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                print(f"Error converting {futures[future]}: {exc}")
+            else:
+                converted.append(futures[future])
+    return converted
 
 
 def remove_images(images: list[Path], to_trash: bool = True) -> None:
@@ -82,34 +145,56 @@ def convert_loop() -> None:
         type=Path,
         help="Folder to output CBZs",
     )
+    parser.add_argument(
+        "--workers", type=int, default=WORKERS, help="PDFs converted at once"
+    )
+    parser.add_argument(
+        "--scratch",
+        type=Path,
+        default=SCRATCH_FOLDER,
+        help="Where pages are rasterised, a tmpfs by default",
+    )
 
     args = parser.parse_args()
     input_folder = args.input_folder
     output_folder = args.output_folder
 
     while True:
-        for pdf_file in input_folder.rglob("*.pdf"):
-            bd_path = convert_to_img(pdf_file)
-            images = compress(bd_path, output_folder)
-            remove_images(images)
-            pdf_file.move_to(output_folder / pdf_file.name)
+        pdf_files = list(input_folder.rglob("*.pdf"))
+        for pdf_file in convert_all(
+            pdf_files, output_folder, args.workers, args.scratch
+        ):
+            shutil.move(pdf_file, output_folder / pdf_file.name)
 
         print("Waiting for new files...")
         time.sleep(30)
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--workers", type=int, default=WORKERS, help="PDFs converted at once"
+    )
+    parser.add_argument(
+        "--scratch",
+        type=Path,
+        default=SCRATCH_FOLDER,
+        help="Where pages are rasterised, a tmpfs by default",
+    )
+    args = parser.parse_args()
+
     if BDS:
         return convert_from_list(BDS)
 
+    pdf_files: list[Path] = []
     for index, pdf_file in enumerate(BD_FOLDER.rglob("*.pdf")):
-        bd_path = convert_to_img(pdf_file)
-        images = compress(bd_path)
-        remove_images(images)
+        pdf_files.append(pdf_file)
 
         if index > MAX_PER_RUN:
             break
 
+    convert_all(pdf_files, workers=args.workers, scratch_folder=args.scratch)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import json
+import math
+import threading
+import time
+from pathlib import Path
+from typing import Callable, TypedDict, TypeVar
+from zipfile import BadZipFile, ZipFile
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None  # type: ignore[assignment]
+
+PAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".avif", ".jxl"}
+# Files listed in the report, slowest first
+SLOWEST_FILES = 20
+
+T = TypeVar("T")
+
+
+class ActionStats(TypedDict):
+    file: str
+    action: str
+    success: bool
+    wall_time: float
+    # CPU time of the worker threads and of the processes it ran (pdftoppm,
+    # unrar...)
+    cpu_time: float
+    bytes_in: int
+    bytes_out: int
+    pages: int
+    # Codec of the re-encoded pages, how many there were and time spent
+    # encoding them. Pages copied as is are not counted.
+    codec: str
+    reencoded: int
+    encode_time: float
+
+
+# Time spent encoding pages in this process, by every thread, and pages
+# re-encoded
+_encode_time = 0.0
+_reencoded = 0
+_encode_lock = threading.Lock()
+
+
+def add_encode_time(seconds: float) -> None:
+    global _encode_time
+
+    with _encode_lock:
+        _encode_time += seconds
+
+
+def add_reencoded(pages: int) -> None:
+    global _reencoded
+
+    with _encode_lock:
+        _reencoded += pages
+
+
+def cpu_time() -> float:
+    total = time.process_time()
+    if resource is not None:
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        total += children.ru_utime + children.ru_stime
+    return total
+
+
+def file_size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def count_pages(path: Path) -> int:
+    if path.suffix.lower() != ".zip":
+        return 0
+
+    try:
+        with ZipFile(path) as zip_:
+            return sum(
+                Path(name).suffix.lower() in PAGE_EXTENSIONS for name in zip_.namelist()
+            )
+    except (OSError, BadZipFile):
+        return 0
+
+
+def profile(
+    book: Path,
+    name: str,
+    func: Callable[[Path], T],
+    path: Path,
+    stats: list[ActionStats],
+    codec: str = "",
+) -> T:
+    # Run func on path and append its measures to stats, even when it fails
+    bytes_in = file_size(path)
+    start_wall, start_cpu = time.perf_counter(), cpu_time()
+    start_encode, start_reencoded = _encode_time, _reencoded
+    success = False
+    try:
+        result = func(path)
+        success = True
+    finally:
+        wall_time = time.perf_counter() - start_wall
+        cpu_time_ = cpu_time() - start_cpu
+        output = Path(result) if success else path  # type: ignore[arg-type]
+        stats.append(
+            ActionStats(
+                file=str(book),
+                action=name,
+                success=success,
+                wall_time=wall_time,
+                cpu_time=cpu_time_,
+                bytes_in=bytes_in,
+                bytes_out=file_size(output),
+                pages=count_pages(output),
+                codec=codec,
+                reencoded=_reencoded - start_reencoded,
+                encode_time=_encode_time - start_encode,
+            )
+        )
+    return result
+
+
+def percentile(values: list[float], percent: float) -> float:
+    # Nearest-rank percentile
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    rank = math.ceil(percent / 100 * len(values))
+    return values[max(rank, 1) - 1]
+
+
+def build_report(stats: list[ActionStats]) -> dict:
+    actions: dict[str, list[ActionStats]] = {}
+    files: dict[str, float] = {}
+    for stat in stats:
+        actions.setdefault(stat["action"], []).append(stat)
+        files[stat["file"]] = files.get(stat["file"], 0.0) + stat["wall_time"]
+
+    report_actions = {}
+    for action, action_stats in actions.items():
+        wall_times = [stat["wall_time"] for stat in action_stats]
+        cpu_times = [stat["cpu_time"] for stat in action_stats]
+        report_actions[action] = {
+            "runs": len(action_stats),
+            "failures": sum(not stat["success"] for stat in action_stats),
+            "wall_time": sum(wall_times),
+            "wall_time_p50": percentile(wall_times, 50),
+            "wall_time_p95": percentile(wall_times, 95),
+            "cpu_time": sum(cpu_times),
+            "cpu_time_p50": percentile(cpu_times, 50),
+            "cpu_time_p95": percentile(cpu_times, 95),
+            "bytes_in": sum(stat["bytes_in"] for stat in action_stats),
+            "bytes_out": sum(stat["bytes_out"] for stat in action_stats),
+            "pages": sum(stat["pages"] for stat in action_stats),
+        }
+
+    # Actions which re-encoded pages, by codec
+    codecs: dict[str, dict] = {}
+    for stat in stats:
+        if not stat["reencoded"]:
+            continue
+
+        codec = codecs.setdefault(
+            stat["codec"],
+            {"runs": 0, "pages": 0, "bytes_in": 0, "bytes_out": 0, "encode_time": 0.0},
+        )
+        codec["runs"] += 1
+        codec["pages"] += stat["reencoded"]
+        codec["bytes_in"] += stat["bytes_in"]
+        codec["bytes_out"] += stat["bytes_out"]
+        codec["encode_time"] += stat["encode_time"]
+
+    for codec in codecs.values():
+        codec["size_reduction"] = (
+            1 - codec["bytes_out"] / codec["bytes_in"] if codec["bytes_in"] else 0.0
+        )
+        codec["encode_time_per_page"] = (
+            codec["encode_time"] / codec["pages"] if codec["pages"] else 0.0
+        )
+
+    slowest = sorted(files.items(), key=lambda item: item[1], reverse=True)
+    return {
+        "files": len(files),
+        "wall_time": sum(files.values()),
+        "actions": report_actions,
+        "codecs": codecs,
+        "slowest_files": [
+            {
+                "file": file_,
+                "wall_time": wall_time,
+                "actions": {
+                    stat["action"]: stat["wall_time"]
+                    for stat in stats
+                    if stat["file"] == file_
+                },
+            }
+            for file_, wall_time in slowest[:SLOWEST_FILES]
+        ],
+    }
+
+
+def write_report(path: Path, stats: list[ActionStats]) -> None:
+    with path.open("w", encoding="utf-8") as file_:
+        json.dump(build_report(stats), file_, indent=2, ensure_ascii=False)
@@ -3,21 +3,50 @@ from __future__ import annotations
 import argparse
 import atexit
 import glob
+import importlib
 import logging
+import math
+import os
 import re
 import shutil
+import signal
 import subprocess
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import time
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+from dataclasses import dataclass, field, replace
+from functools import partial
 from io import BytesIO
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Callable, TypedDict, TypeVar
-from zipfile import ZipFile
+from typing import Callable, Iterable, Iterator, TypedDict, TypeVar
+from zipfile import ZipFile, ZipInfo
 
 from PIL import Image
 from send2trash import send2trash
 
+from range_bd.manifest import FAILURE, MANIFEST_NAME, PENDING, SUCCESS, Manifest
+from range_bd.report import (
+    ActionStats,
+    add_encode_time,
+    add_reencoded,
+    profile,
+    write_report,
+)
 from range_bd.unrar import create_cbz
+from range_bd.watcher import watch
+from range_bd.zip_copy import copy_member
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore[assignment]
 
 logger = logging.getLogger("Sanitizer")
 IGNORED_FOLDERS = ["__MACOSX", "._.DS_Store", ".DS_Store", "@eaDir"]
@@ -36,6 +65,8 @@ FOLLOWED_FOLDERS: list[Path]
 MANAGED_FOLDER: Path
 
 SUCCESS_FOLDER: Path
+SUCCESS_FOLDER_NAME = "success"
+FAILURE_FOLDER_PATTERN = re.compile(r"^(\d{2})_(\w+)$")
 
 EPUB_FOLDER: Path
 
@@ -75,7 +106,7 @@ def remove_mac_folder_from_zip(path: Path) -> Path:
                 for name in zip_.namelist():
                     if "__MACOSX" in name:
                         continue
-                    new_zip.writestr(name, zip_.read(name))
+                    copy_member(zip_, zip_.getinfo(name), new_zip)
             path.unlink()
             new_path.rename(path)
     return path
@@ -101,21 +132,67 @@ JUNK = [
     r"\d*\[One-Shot\]",
 ]
 JUNK_PATTERNS = [re.compile(x) for x in JUNK]
+JUNK_PATTERN = re.compile("|".join(f"(?:{x})" for x in JUNK))
 
 
-def clean_name(path: Path) -> Path:
+def plan_name(stem: str) -> str:
     # Ensure no space at the end or beginning of the name
-    path = path.rename(path.with_stem(path.stem.strip()))
+    stem = stem.strip()
 
-    for pattern in JUNK_PATTERNS:
-        path = path.rename(path.with_stem(pattern.sub("", path.stem)))
+    # Removing some junk may reveal more of it, e.g. "[BD Fr] BD ..."
+    while (cleaned := JUNK_PATTERN.sub("", stem)) != stem:
+        stem = cleaned
 
     # Regex in order to change T01 to #01
-    if match := NAME_PATTERN.search(path.stem):
+    if match := NAME_PATTERN.search(stem):
         number = match.group(1)
-        path = path.rename(path.with_stem(NAME_PATTERN.sub(f" #{number} ", path.stem)))
+        stem = NAME_PATTERN.sub(f" #{number} ", stem)
 
-    return path
+    return stem
+
+
+def clean_name(path: Path) -> Path:
+    new_path = path.with_stem(plan_name(path.stem))
+    if new_path == path:
+        return path
+
+    return path.rename(new_path)
+
+
+def plan_clean_names(folder: Path) -> dict[Path, Path]:
+    # Map each book of the tree whose name changes to its cleaned name. Books
+    # that would collide with another book are left out.
+    renames: dict[Path, Path] = {}
+    targets: dict[str, list[Path]] = {}
+
+    for path in sorted(folder.rglob("*")):
+        if path.suffix.lower() not in SUFFIXES or not path.is_file():
+            continue
+
+        new_path = path.with_stem(plan_name(path.stem))
+        # Library shares are often case insensitive
+        targets.setdefault(str(new_path).casefold(), []).append(path)
+        if new_path != path:
+            renames[path] = new_path
+
+    for paths in targets.values():
+        if len(paths) > 1:
+            logger.error("Not renaming %s: they would have the same name", paths)
+            for path in paths:
+                renames.pop(path, None)
+
+    for path, new_path in list(renames.items()):
+        if new_path.exists() and not new_path.samefile(path):
+            logger.error("Not renaming %s: %s already exists", path, new_path)
+            del renames[path]
+
+    return renames
+
+
+def clean_names(folder: Path) -> None:
+    for path, new_path in plan_clean_names(folder).items():
+        logger.info("Renaming %s to %s", path, new_path.name)
+        path.rename(new_path)
 
 
 def natural_sort(files: list[Path]) -> list[Path]:
@@ -128,21 +205,31 @@ def natural_sort(files: list[Path]) -> list[Path]:
     return sorted(files, key=alphanum_key)
 
 
+PAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".avif", ".jxl"}
+
+
+def plan_page_names(names: list[str]) -> list[tuple[str, str]]:
+    # (member, new name) pairs for the pages of an archive, in reading order
+    files = natural_sort([Path(name) for name in names])
+
+    return [
+        (str(file_), f"P{index:05d}{file_.suffix}")
+        for index, file_ in enumerate(files)
+        if file_.suffix.lower() in PAGE_EXTENSIONS
+    ]
+
+
 def rename_images_in_zip_file(path: Path) -> Path:
     tmp_path = path.with_stem(path.stem + "_TMP")
 
     with ZipFile(path) as zip_:
-        files = natural_sort([Path(name) for name in zip_.namelist()])
-
-        for index, file_ in enumerate(files):
-            if file_.suffix.lower() not in [".jpg", ".jpeg", ".png", ".webp"]:
-                continue
-
-            new_name = f"P{index:05d}{file_.suffix}"
-            logger.debug("Renaming %s to %s", file_, new_name)
+        pages = plan_page_names(zip_.namelist())
 
-            with ZipFile(tmp_path, "a") as new_zip:
-                new_zip.writestr(new_name, zip_.read(str(file_)))
+        if pages:
+            with ZipFile(tmp_path, "w") as new_zip:
+                for name, new_name in pages:
+                    logger.debug("Renaming %s to %s", name, new_name)
+                    copy_member(zip_, zip_.getinfo(name), new_zip, new_name)
 
     if tmp_path.exists():
         send2trash(path)
@@ -210,13 +297,43 @@ def change_tome_number_in_files(file_: Path) -> Path:
 # PDF conversion
 DPI = 300
 MAX_HEIGHT = 4000
-
-
-def convert_to_img(pdf_file: Path, output_folder: Path) -> Path:
+# Pages rasterised by each pdftoppm process. 0 rasterises the whole document
+# at once without counting its pages first.
+PDF_RANGE_SIZE = 16
+# pdftoppm processes running at the same time on one document
+PDF_WORKERS = 4
+PDF_PAGES_PATTERN = re.compile(rb"^Pages:\s+(\d+)", re.MULTILINE)
+
+
+def count_pdf_pages(pdf_file: Path) -> int | None:
+    try:
+        result = subprocess.run(
+            ["pdfinfo", str(pdf_file)], check=True, capture_output=True
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning("Cannot count pages of %s: %s", pdf_file, e)
+        return None
+
+    if match := PDF_PAGES_PATTERN.search(result.stdout):
+        return int(match.group(1))
+    return None
+
+
+def convert_to_img(
+    pdf_file: Path,
+    output_folder: Path,
+    first_page: int | None = None,
+    last_page: int | None = None,
+) -> Path:
     logger.info("Converting %s to images in output %s", pdf_file, output_folder)
+    page_range: list[str] = []
+    if first_page is not None and last_page is not None:
+        page_range = ["-f", str(first_page), "-l", str(last_page)]
+
     subprocess.run(
         [
             "pdftoppm",
+            *page_range,
             "-scale-to",
             str(MAX_HEIGHT),
             "-r",
@@ -230,31 +347,89 @@ def convert_to_img(pdf_file: Path, output_folder: Path) -> Path:
     return pdf_file
 
 
+def rasterise(pdf_file: Path, output_folder: Path) -> Iterator[list[Path]]:
+    # Yield the pages of each page range as soon as it is rasterised
+    page_count = count_pdf_pages(pdf_file) if PDF_RANGE_SIZE else None
+
+    if page_count is None:
+        convert_to_img(pdf_file, output_folder)
+        yield sorted(output_folder.glob("*.png"))
+        return
+
+    # At most PDF_WORKERS ranges are rasterised or waiting to be consumed:
+    # the next range starts once the pages of a range have been taken
+    first_pages = iter(range(1, page_count + 1, PDF_RANGE_SIZE))
+
+    with ThreadPoolExecutor(max_workers=PDF_WORKERS) as executor:
+        futures: dict[Future[Path], Path] = {}
+
+        def submit_next() -> None:
+            first_page = next(first_pages, None)
+            if first_page is None:
+                return
+            last_page = min(first_page + PDF_RANGE_SIZE - 1, page_count)
+
+            range_folder = output_folder / f"{first_page:05d}"
+            range_folder.mkdir()
+            future = executor.submit(
+                convert_to_img, pdf_file, range_folder, first_page, last_page
+            )
+            futures[future] = range_folder
+
+        for _ in range(PDF_WORKERS):
+            submit_next()
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                range_folder = futures.pop(future)
+                future.result()
+                yield sorted(range_folder.glob("*.png"))
+                submit_next()
+
+
+def encode_page(image_path: Path) -> bytes:
+    with Image.open(str(image_path)) as image:
+        data = resize_jpg(image).getvalue()
+    image_path.unlink()
+    return data
+
+
 def compress(bd_path: Path, image_folder: Path) -> Path:
     cbz_file_path = bd_path.with_suffix(".zip")
 
     logger.info("Creating %s", cbz_file_path)
 
     with ZipFile(cbz_file_path, "w") as cbz_file:
-        for image_path in image_folder.glob("*.png"):
-            new_path = image_path.with_suffix(".jpg")
-
-            image = Image.open(str(image_path))
-            buffer = resize_jpg(image)
-            cbz_file.writestr(str(new_path), buffer.getvalue())
+        write_pages(cbz_file, [sorted(image_folder.glob("*.png"))])
 
     return cbz_file_path
 
 
+def write_pages(cbz_file: ZipFile, batches: Iterable[list[Path]]) -> None:
+    # Pages of a batch are encoded in parallel while the next one is produced
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        for batch in batches:
+            for image_path, data in zip(batch, executor.map(encode_page, batch)):
+                new_path = image_path.with_suffix(CODEC.suffixes[0])
+                cbz_file.writestr(str(new_path), data)
+            add_reencoded(len(batch))
+
+
 def convert_pdf(file_: Path) -> Path:
     if file_.suffix.lower() != PDF_SUFFIX:
         return file_
 
+    cbz_file_path = file_.with_suffix(".zip")
+
     with TemporaryDirectory() as tmp_dir:
         tmp_dir = Path(tmp_dir)
-        convert_to_img(file_, tmp_dir)
-        new_path = compress(file_, tmp_dir)
-    return new_path
+
+        logger.info("Creating %s", cbz_file_path)
+        with ZipFile(cbz_file_path, "w") as cbz_file:
+            write_pages(cbz_file, rasterise(file_, tmp_dir))
+
+    return cbz_file_path
 
 
 # JPG resize
@@ -262,11 +437,93 @@ EXPECTED_DPI = 120
 EXPECTED_HEIGHT = 2388
 JPG_QUALITY = 90
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png"}
+# Threads resizing the pages of one archive. Pillow releases the GIL while
+# decoding, resizing and encoding.
+PAGE_WORKERS = 4
+# JPEG pages much taller than EXPECTED_HEIGHT are decoded at 1/2, 1/4 or 1/8
+# of their size by the DCT, as long as the decoded page stays at least this
+# many times EXPECTED_HEIGHT before the final resize. 0 always fully decodes.
+DRAFT_MIN_SCALE = 1.0
+
+
+@dataclass
+class Codec:
+    name: str
+    # Pillow format
+    format: str
+    suffixes: list[str]
+    quality: int
+    options: dict[str, object] = field(default_factory=dict)
+    # Module registering the format in Pillow, when it is not built in
+    plugin: str | None = None
+
+
+CODECS = {
+    codec.name: codec
+    for codec in [
+        Codec(
+            "jpeg",
+            "JPEG",
+            [".jpg", ".jpeg"],
+            JPG_QUALITY,
+            {"optimize": True, "dpi": (EXPECTED_DPI, EXPECTED_DPI)},
+        ),
+        Codec("webp", "WEBP", [".webp"], 80, {"method": 4}),
+        Codec("avif", "AVIF", [".avif"], 60, {"speed": 6}, "pillow_avif"),
+        Codec("jxl", "JXL", [".jxl"], 85, {}, "pillow_jxl"),
+    ]
+}
+# Codec and quality for each kind of target
+PROFILES = {
+    "archive": ("jpeg", JPG_QUALITY),
+    "reader": ("webp", 80),
+    "compact": ("avif", 60),
+}
+CODEC = CODECS["jpeg"]
+
+
+def codec_available(codec: Codec) -> bool:
+    Image.init()
+    if codec.format not in Image.SAVE and codec.plugin is not None:
+        try:
+            importlib.import_module(codec.plugin)
+        except ImportError:
+            return False
+    return codec.format in Image.SAVE
+
+
+def configure(
+    page_workers: int,
+    pdf_workers: int,
+    pdf_range_size: int,
+    codec: str = "jpeg",
+    quality: int | None = None,
+    draft_min_scale: float = DRAFT_MIN_SCALE,
+) -> None:
+    global PAGE_WORKERS, PDF_WORKERS, PDF_RANGE_SIZE, CODEC, DRAFT_MIN_SCALE
+
+    PAGE_WORKERS = page_workers
+    PDF_WORKERS = pdf_workers
+    PDF_RANGE_SIZE = pdf_range_size
+    DRAFT_MIN_SCALE = draft_min_scale
+
+    CODEC = CODECS[codec]
+    if quality is not None:
+        CODEC = replace(CODEC, quality=quality)
+    # Registers the plugin in this process
+    if not codec_available(CODEC):
+        raise RuntimeError(f"Pillow cannot encode {CODEC.name}")
 
 
 def resize_jpg(img: Image.Image) -> BytesIO:
+    # Resize to EXPECTED_HEIGHT and encode with the configured codec
     buffer = BytesIO()
     width, height = img.size
+    if DRAFT_MIN_SCALE and img.format == "JPEG" and height > EXPECTED_HEIGHT:
+        # Only possible while the pixels are not loaded yet
+        scale = DRAFT_MIN_SCALE * EXPECTED_HEIGHT / height
+        img.draft(img.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+        width, height = img.size
     if height > EXPECTED_HEIGHT:
         new_height = EXPECTED_HEIGHT
         new_width = int((new_height / height) * width)
@@ -276,16 +533,105 @@ def resize_jpg(img: Image.Image) -> BytesIO:
         img = img.convert("RGB")
         # some minor case, resulting jpg file is larger one, should meet your expectation
 
-    img.save(
-        buffer,
-        format="JPEG",
-        optimize=True,
-        quality=JPG_QUALITY,
-        dpi=(EXPECTED_DPI, EXPECTED_DPI),
-    )
+    start = time.perf_counter()
+    img.save(buffer, format=CODEC.format, quality=CODEC.quality, **CODEC.options)
+    add_encode_time(time.perf_counter() - start)
     return buffer
 
 
+def page_name(name: str) -> str:
+    # Name of a page once encoded with the configured codec
+    path = Path(name)
+    if path.suffix.lower() in CODEC.suffixes:
+        return name
+    return str(path.with_suffix(CODEC.suffixes[0]))
+
+
+# Pages already in the target format that can be copied as they are
+COMPLIANT_MODES = {"RGB", "L"}
+
+
+def is_compliant(img: Image.Image) -> bool:
+    # Only relies on the header: Image.open does not decode the pixels
+    return (
+        img.format == CODEC.format
+        and img.mode in COMPLIANT_MODES
+        and img.size[1] <= EXPECTED_HEIGHT
+    )
+
+
+def is_page(name: str) -> bool:
+    suffix = Path(name).suffix.lower()
+    return suffix in IMAGE_EXTENSIONS or suffix in CODEC.suffixes
+
+
+def transform_page(data: bytes) -> bytes | None:
+    # Return the re-encoded page, or None when it can be copied as is
+    image = Image.open(BytesIO(data))
+    if is_compliant(image):
+        return None
+
+    return resize_jpg(image).getvalue()
+
+
+class PageStats(TypedDict):
+    passed_through: int
+    reencoded: int
+
+
+def transform_pages(
+    zip_: ZipFile, pages: list[tuple[str, str]], stats: PageStats
+) -> Iterator[tuple[ZipInfo, str, bytes | None]]:
+    # Yield the source member, its new name and its re-encoded content, or
+    # None when it is to be copied as is. Pages are transformed by a thread
+    # pool but yielded in the given order. Only a few pages are in flight at
+    # once to bound memory usage.
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        pending: deque[tuple[ZipInfo, str, Future[bytes | None] | None]] = deque()
+
+        def pop() -> tuple[ZipInfo, str, bytes | None]:
+            source, new_name, future = pending.popleft()
+            if future is None:
+                return source, new_name, None
+
+            data = future.result()
+            if data is None:
+                stats["passed_through"] += 1
+            else:
+                stats["reencoded"] += 1
+                new_name = page_name(new_name)
+
+            return source, new_name, data
+
+        for name, new_name in pages:
+            source = zip_.getinfo(name)
+            future = None
+            if is_page(name):
+                future = executor.submit(transform_page, zip_.read(name))
+            pending.append((source, new_name, future))
+
+            if len(pending) >= 2 * PAGE_WORKERS:
+                yield pop()
+
+        while pending:
+            yield pop()
+
+
+def write_pages_to_zip(
+    zip_: ZipFile, new_zip: ZipFile, pages: list[tuple[str, str]], stats: PageStats
+) -> None:
+    # Members left untouched are copied without being decompressed
+    for source, new_name, data in transform_pages(zip_, pages, stats):
+        logger.debug("Writing %s", new_name)
+        if data is None:
+            copy_member(zip_, source, new_zip, new_name)
+        else:
+            # Keep the source metadata so that the output is reproducible
+            info = ZipInfo(new_name, date_time=source.date_time)
+            info.external_attr = source.external_attr
+            new_zip.writestr(info, data)
+
+
 def resize_jpg_in_zip(path: Path) -> Path:
     if not path.suffix.lower() == ZIP_SUFFIX:
         return path
@@ -295,16 +641,60 @@ def resize_jpg_in_zip(path: Path) -> Path:
 
         new_path = path.with_stem(path.stem + "_RESIZED")
 
+        stats = PageStats(passed_through=0, reencoded=0)
         with ZipFile(new_path, "w") as new_zip:
-            for name in zip_.namelist():
-                data = zip_.read(name)
+            pages = [(name, name) for name in zip_.namelist()]
+            write_pages_to_zip(zip_, new_zip, pages, stats)
+        add_reencoded(stats["reencoded"])
+
+        logger.info(
+            "%s: %d pages re-encoded, %d passed through",
+            path,
+            stats["reencoded"],
+            stats["passed_through"],
+        )
+    path.unlink()
+    new_path.rename(path)
 
-                if Path(name).suffix.lower() in IMAGE_EXTENSIONS:
-                    image = Image.open(BytesIO(data))
-                    buffer = resize_jpg(image)
-                    new_zip.writestr(name, buffer.getvalue())
-                else:
-                    new_zip.writestr(name, data)
+    return path
+
+
+def transform_zip(path: Path) -> Path:
+    # Remove __MACOSX, rename and resize pages in a single pass over the archive
+    if path.suffix.lower() != ZIP_SUFFIX:
+        return path
+
+    with ZipFile(path, "r") as zip_:
+        logger.info("Transforming %s", path)
+
+        names = [name for name in zip_.namelist() if "__MACOSX" not in name]
+        pages = plan_page_names(names)
+        if not pages:
+            # Nothing to rename: only keep what is not __MACOSX
+            pages = [(name, name) for name in names]
+        else:
+            # Metadata such as ComicInfo.xml is copied under its own name. The
+            # folders the pages were in are left out, as pages are renamed.
+            renamed = {name for name, _ in pages}
+            pages += [
+                (name, name)
+                for name in names
+                if name not in renamed and not name.endswith("/")
+            ]
+
+        new_path = path.with_stem(path.stem + "_TRANSFORMED")
+
+        stats = PageStats(passed_through=0, reencoded=0)
+        with ZipFile(new_path, "w") as new_zip:
+            write_pages_to_zip(zip_, new_zip, pages, stats)
+        add_reencoded(stats["reencoded"])
+
+        logger.info(
+            "%s: %d pages re-encoded, %d passed through",
+            path,
+            stats["reencoded"],
+            stats["passed_through"],
+        )
     path.unlink()
     new_path.rename(path)
 
@@ -315,42 +705,138 @@ ACTIONS: list[Callable[[Path], Path]] = [
     change_tome_number_in_files,
     rename_cbz,
     unrar,
-    remove_mac_folders,
     convert_pdf,
-    rename_images_in_zip_files,
-    resize_jpg_in_zip,
+    transform_zip,
 ]
 
 
+# ioctl cloning a whole file on copy-on-write filesystems (Btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def reflink(source: Path, destination: Path) -> None:
+    if fcntl is None:
+        raise OSError("Reflinks are not supported on this platform")
+
+    try:
+        with source.open("rb") as src, destination.open("wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except OSError:
+        destination.unlink(missing_ok=True)
+        raise
+
+
+def link_or_copy(source: Path, destination: Path) -> Path:
+    # Actions never modify a file in place: they write a new file and remove
+    # the former one. The working file may thus share its data with the
+    # source when both are on the same filesystem.
+    try:
+        os.link(source, destination)
+    except OSError:
+        pass
+    else:
+        logger.info("Link file %s to new path %s", source, destination)
+        return destination
+
+    try:
+        reflink(source, destination)
+    except OSError:
+        pass
+    else:
+        logger.info("Reflink file %s to new path %s", source, destination)
+        return destination
+
+    logger.info("Move file %s to new path %s", source, destination)
+    return shutil.copy(source, destination)
+
+
 def per_file_pipeline(
     file_: Path,
     remote_folder: Path,
     success_folder: Path,
     failure_folder: Path,
-) -> None:
+    manifest_path: Path | None = None,
+    work_dir: Path | None = None,
+) -> list[ActionStats]:
+    # Return the measures of each action run on the file
     if not file_.is_file():
-        return
+        return []
 
     if file_.suffix.lower() not in SUFFIXES:
-        return
+        return []
+
+    if manifest_path is None:
+        return run_pipeline(
+            file_, remote_folder, success_folder, failure_folder, None, work_dir
+        )
 
+    with Manifest(manifest_path) as manifest:
+        return run_pipeline(
+            file_, remote_folder, success_folder, failure_folder, manifest, work_dir
+        )
+
+
+def run_pipeline(
+    file_: Path,
+    remote_folder: Path,
+    success_folder: Path,
+    failure_folder: Path,
+    manifest: Manifest | None = None,
+    work_dir: Path | None = None,
+) -> list[ActionStats]:
     former_path = file_
+    stats: list[ActionStats] = []
+
+    start = 0
+    source_hash: str | None = None
+    if manifest is not None:
+        source_hash, entry = manifest.lookup(file_)
+        resolved_path = file_.resolve()
+
+        if entry is not None and entry.status == SUCCESS:
+            if entry.path != resolved_path:
+                # Same bytes as another book: left where it is
+                logger.warning("Skip %s: duplicate of %s", file_, entry.path)
+                return stats
+
+            logger.info("Skip %s: already processed into %s", file_, entry.output)
+            if entry.output is not None and entry.output != resolved_path:
+                if entry.output.exists():
+                    # Left over by a run interrupted before the source was removed
+                    logger.info("Remove former file %s", file_)
+                    send2trash(str(file_))
+            return stats
+
+        if entry is not None and entry.completed:
+            start = entry.completed
+            logger.info("Resume %s after %s", file_, ACTIONS[start - 1].__name__)
+
+        manifest.record(file_, start, None, PENDING, hash_=source_hash)
 
     relative_path = remove_parents_from_path(file_, remote_folder)
 
-    with TemporaryDirectory() as tmp_dir:
+    with TemporaryDirectory(dir=work_dir) as tmp_dir:
         working_folder = Path(tmp_dir)
 
         working_path = working_folder / relative_path
         working_path.parent.mkdir(exist_ok=True, parents=True)
-        logger.info("Move file %s to new path %s", file_, working_path)
-        file_ = shutil.copy(file_, working_path)
+        file_ = profile(
+            former_path,
+            "link_or_copy",
+            lambda path: link_or_copy(path, working_path),
+            file_,
+            stats,
+            CODEC.name,
+        )
 
         success = False
         new_path: Path | None = None
-        for index, action in enumerate(ACTIONS):
+        completed = start
+        for index, action in enumerate(ACTIONS[start:], start):
             try:
-                file_ = action(file_)
+                file_ = profile(
+                    former_path, action.__name__, action, file_, stats, CODEC.name
+                )
             except Exception as e:
                 logger.error("Error running %s on %s: %s", action.__name__, file_, e)
                 success = False
@@ -360,6 +846,11 @@ def per_file_pipeline(
                 break
             else:
                 success = True
+                completed = index + 1
+                if manifest is not None:
+                    manifest.record(
+                        former_path, start, action.__name__, PENDING, hash_=source_hash
+                    )
 
         if success:
             logger.info("Success running pipeline on %s", file_)
@@ -374,13 +865,194 @@ def per_file_pipeline(
             raise RuntimeError(f"File {new_path} already exists")
 
         try:
-            file_ = shutil.move(file_, new_path)
+            profile(
+                former_path,
+                "move",
+                lambda path: shutil.move(path, new_path),
+                file_,
+                stats,
+                CODEC.name,
+            )
         except Exception:
             raise
         else:
+            if manifest is not None:
+                last_action = ACTIONS[completed - 1].__name__ if completed else None
+                manifest.record(
+                    former_path,
+                    start,
+                    last_action,
+                    SUCCESS if success else FAILURE,
+                    new_path,
+                    source_hash,
+                )
+                # Recorded last as it may have the same content as the source:
+                # a failed book resumes from the failing action when run again
+                if success:
+                    manifest.record(new_path, completed, last_action, SUCCESS, new_path)
+                else:
+                    manifest.record(new_path, completed, last_action, PENDING)
+
             logger.info("Remove former file %s", former_path)
             send2trash(str(former_path))
 
+    return stats
+
+
+def rebuild_manifest(manifest: Manifest, managed_folder: Path) -> None:
+    # Index the books already sorted in the managed folder: the success
+    # folder holds finished books, NN_action folders books that failed on
+    # action NN and can resume from there.
+    logger.info("Rebuilding manifest %s", manifest.path)
+    manifest.clear()
+
+    action_names = [action.__name__ for action in ACTIONS]
+
+    for folder in managed_folder.iterdir():
+        if not folder.is_dir():
+            continue
+
+        if folder.name == SUCCESS_FOLDER_NAME:
+            completed = len(ACTIONS)
+            status = SUCCESS
+        elif (match := FAILURE_FOLDER_PATTERN.match(folder.name)) and (
+            int(match.group(1)) < len(ACTIONS)
+            and action_names[int(match.group(1))] == match.group(2)
+        ):
+            completed = int(match.group(1))
+            status = PENDING
+        else:
+            continue
+
+        for file_ in folder.rglob("*"):
+            if not file_.is_file() or file_.suffix.lower() not in SUFFIXES:
+                continue
+
+            logger.debug("Indexing %s", file_)
+            last_action = action_names[completed - 1] if completed else None
+            output = file_ if status == SUCCESS else None
+            manifest.record(file_, completed, last_action, status, output)
+
+
+# Relative cost of processing one byte of each format
+FORMAT_WEIGHTS = {
+    PDF_SUFFIX: 4.0,
+    CBR_SUFFIX: 1.5,
+    RAR_SUFFIX: 1.5,
+    ZIP_SUFFIX: 1.0,
+    CBZ_SUFFIX: 1.0,
+    EPUB_SUFFIX: 0.1,
+}
+# Decoded 4000 px tall page: transform_pages keeps 2 * PAGE_WORKERS of them
+# in flight, along with their compressed data
+PAGE_MEMORY = 4000 * 2800 * 3
+# pdftoppm process: the page it renders at DPI, plus the parsed document
+RENDER_MEMORY = PAGE_MEMORY + 64 * 1024**2
+MEMORY_BUDGET = 4 * 1024**3
+
+
+@dataclass
+class Job:
+    path: Path
+    cost: float
+    memory: int
+
+
+def job_memory(suffix: str) -> int:
+    # Peak memory of a book. A PDF is first rendered by PDF_WORKERS pdftoppm
+    # processes while write_pages encodes the previous pages, then
+    # transformed as an archive.
+    archive = 2 * PAGE_WORKERS * PAGE_MEMORY
+    if suffix != PDF_SUFFIX:
+        return archive
+
+    conversion = PDF_WORKERS * RENDER_MEMORY + PAGE_WORKERS * PAGE_MEMORY
+    return max(archive, conversion)
+
+
+def plan_jobs(files: Iterable[Path]) -> list[Job]:
+    # Only keep the supported books, the most expensive first so that a big
+    # PDF found last does not run alone at the end of the batch
+    jobs: list[Job] = []
+    for file_ in files:
+        suffix = file_.suffix.lower()
+        if suffix not in SUFFIXES or not file_.is_file():
+            continue
+
+        cost = file_.stat().st_size * FORMAT_WEIGHTS[suffix]
+        jobs.append(Job(file_, cost, job_memory(suffix)))
+
+    return sorted(jobs, key=lambda job: job.cost, reverse=True)
+
+
+def schedule(
+    jobs: list[Job],
+    submit: Callable[[Job], Future[list[ActionStats]]],
+    memory_budget: int,
+) -> Iterator[tuple[Job, Future[list[ActionStats]]]]:
+    # Submit jobs in order while their estimated memory fits in the budget.
+    # One job is always running, even if it does not fit on its own.
+    pending = deque(jobs)
+    running: dict[Future[list[ActionStats]], Job] = {}
+    used = 0
+
+    while pending or running:
+        while pending and (not running or used + pending[0].memory <= memory_budget):
+            job = pending.popleft()
+            running[submit(job)] = job
+            used += job.memory
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            job = running.pop(future)
+            used -= job.memory
+            yield job, future
+
+
+def init_watch_worker(*settings) -> None:
+    # Let the books being processed finish when watching is interrupted
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    configure(*settings)
+
+
+def watch_library(
+    path: Path,
+    settings: tuple[int, int, int, str, int | None, float],
+    manifest_path: Path,
+    work_dir: Path | None,
+    poll: bool,
+    stats: list[ActionStats],
+) -> None:
+    # Process the books written to path as they arrive, until interrupted
+    with ProcessPoolExecutor(
+        initializer=init_watch_worker, initargs=settings
+    ) as executor:
+        # Start the workers now rather than when the first book arrives
+        executor.submit(configure, *settings).result()
+
+        def collect(file_: Path, future: Future[list[ActionStats]]) -> None:
+            try:
+                stats.extend(future.result())
+            except Exception as exc:
+                logger.error("Error running pipeline on %s: %s", file_, exc)
+
+        def submit(file_: Path) -> None:
+            future = executor.submit(
+                per_file_pipeline,
+                file_,
+                path,
+                SUCCESS_FOLDER,
+                MANAGED_FOLDER,
+                manifest_path,
+                work_dir,
+            )
+            future.add_done_callback(partial(collect, file_))
+
+        try:
+            watch(path, SUFFIXES, submit, poll)
+        except KeyboardInterrupt:
+            logger.info("Stop watching %s", path)
+
 
 def main() -> None:
     logger = logging.getLogger("Sanitizer")
@@ -398,26 +1070,159 @@ def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("path", type=Path, default=working_dir, nargs="?")
     parser.add_argument("--debug", action="store_true", default=False)
+    parser.add_argument(
+        "--clean-names",
+        action="store_true",
+        default=False,
+        help="Only clean the names of the books in place",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help="Process the books added to the folder as they arrive",
+    )
+    parser.add_argument(
+        "--poll",
+        action="store_true",
+        default=False,
+        help="Watch by polling, for network shares",
+    )
+    parser.add_argument(
+        "--rebuild-manifest",
+        action="store_true",
+        default=False,
+        help="Index again the books already in the managed folder",
+    )
+    parser.add_argument(
+        "--page-workers",
+        type=int,
+        default=PAGE_WORKERS,
+        help="Threads resizing the pages of each book",
+    )
+    parser.add_argument(
+        "--pdf-workers",
+        type=int,
+        default=PDF_WORKERS,
+        help="pdftoppm processes rasterising each PDF",
+    )
+    parser.add_argument(
+        "--pdf-range-size",
+        type=int,
+        default=PDF_RANGE_SIZE,
+        help="Pages rasterised by each pdftoppm process, "
+        "0 to rasterise whole PDFs without counting their pages",
+    )
+    parser.add_argument(
+        "--profile",
+        choices=sorted(PROFILES),
+        default=None,
+        help="Codec and quality of the pages for a kind of target, "
+        + ", ".join(f"{name}: {codec} {q}" for name, (codec, q) in PROFILES.items()),
+    )
+    parser.add_argument(
+        "--codec",
+        choices=sorted(CODECS),
+        default=None,
+        help="Codec of the re-encoded pages, overrides the profile",
+    )
+    parser.add_argument(
+        "--quality",
+        type=int,
+        default=None,
+        help="Quality of the re-encoded pages, per codec by default",
+    )
+    parser.add_argument(
+        "--draft-min-scale",
+        type=float,
+        default=DRAFT_MIN_SCALE,
+        help="Decode JPEG pages at reduced size while they stay this many times "
+        "the expected height, 0 to always decode them fully",
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=Path,
+        default=None,
+        help="Where books are processed. Books are linked instead of copied "
+        "when it is on the same filesystem as the library.",
+    )
+    parser.add_argument(
+        "--report",
+        type=Path,
+        default=None,
+        help="JSON file profiling each action, in the managed folder by default",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=int,
+        default=MEMORY_BUDGET // 1024**2,
+        help="Memory in MiB the books processed at the same time may use",
+    )
     args = parser.parse_args()
 
-    path = args.path
+    # Books are recorded in the manifest by their resolved path
+    path = args.path.resolve()
     debug = args.debug
+    codec, quality = PROFILES[args.profile] if args.profile else (CODEC.name, None)
+    if args.codec is not None and args.codec != codec:
+        # The profile quality is meant for another codec
+        codec, quality = args.codec, None
+    if args.quality is not None:
+        quality = args.quality
+
+    settings = (
+        args.page_workers,
+        args.pdf_workers,
+        args.pdf_range_size,
+        codec,
+        quality,
+        args.draft_min_scale,
+    )
+    if not codec_available(CODECS[codec]):
+        parser.error(f"Pillow cannot encode {codec}, is its plugin installed?")
+    if args.page_workers < 1:
+        parser.error("--page-workers must be at least 1")
+    if args.pdf_workers < 1:
+        parser.error("--pdf-workers must be at least 1")
+    if args.pdf_range_size < 0:
+        parser.error("--pdf-range-size must be positive")
+    if args.draft_min_scale and args.draft_min_scale < 1:
+        parser.error("--draft-min-scale must be at least 1, or 0")
+    if args.memory_budget < 1:
+        parser.error("--memory-budget must be at least 1")
+
+    configure(*settings)
+
+    work_dir = args.work_dir
+    if work_dir is not None:
+        work_dir.mkdir(exist_ok=True, parents=True)
+
+    if args.clean_names:
+        if path.is_file():
+            clean_name(path)
+        else:
+            clean_names(path)
+        return
 
     global EPUB_FOLDER, MANAGED_FOLDER, SUCCESS_FOLDER
 
     MANAGED_FOLDER = path.parent / "Bédés gérées"
     MANAGED_FOLDER.mkdir(exist_ok=True)
-    SUCCESS_FOLDER = MANAGED_FOLDER / "success"
+    SUCCESS_FOLDER = MANAGED_FOLDER / SUCCESS_FOLDER_NAME
     SUCCESS_FOLDER.mkdir(exist_ok=True)
     EPUB_FOLDER = path.parent / "EPUB"
     EPUB_FOLDER.mkdir(exist_ok=True)
 
-    if path.is_file():
-        files = [path]
-    else:
-        files = list(path.rglob("*"))
+    manifest_path = MANAGED_FOLDER / MANIFEST_NAME
+    if args.rebuild_manifest:
+        with Manifest(manifest_path) as manifest:
+            rebuild_manifest(manifest, MANAGED_FOLDER)
 
-    atexit.register(remove_empty_folders, [path, MANAGED_FOLDER, SUCCESS_FOLDER])
+    # The watched folder stays, even when empty
+    empty_folders = [MANAGED_FOLDER, SUCCESS_FOLDER]
+    if not args.watch:
+        empty_folders.insert(0, path)
+    atexit.register(remove_empty_folders, empty_folders)
 
     if debug:
         parallel = False
@@ -426,36 +1231,56 @@ def main() -> None:
     else:
         parallel = True
 
-    if parallel:
-        with ProcessPoolExecutor() as executor:
-            futures = [
-                executor.submit(
-                    per_file_pipeline, file_, path, SUCCESS_FOLDER, MANAGED_FOLDER
+    stats: list[ActionStats] = []
+    jobs: list[Job] = []
+    if args.watch:
+        watch_library(path, settings, manifest_path, work_dir, args.poll, stats)
+    else:
+        jobs = plan_jobs([path] if path.is_file() else path.rglob("*"))
+        logger.info("%d books to process", len(jobs))
+
+    if parallel and jobs:
+        with ProcessPoolExecutor(initializer=configure, initargs=settings) as executor:
+
+            def submit(job: Job) -> Future[list[ActionStats]]:
+                return executor.submit(
+                    per_file_pipeline,
+                    job.path,
+                    path,
+                    SUCCESS_FOLDER,
+                    MANAGED_FOLDER,
+                    manifest_path,
+                    work_dir,
                 )
-                for file_ in files
-            ]
-            for future in as_completed(futures):
+
+            memory_budget = args.memory_budget * 1024**2
+            for job, future in schedule(jobs, submit, memory_budget):
                 try:
-                    future.result()
+                    stats.extend(future.result())
                 except Exception as exc:
-                    logger.error("Error running pipeline: %s", exc)
+                    logger.error("Error running pipeline on %s: %s", job.path, exc)
                     continue
     else:
-        for file_ in files:
+        for job in jobs:
             try:
-                if not file_.is_file():
-                    continue
-
-                per_file_pipeline(
-                    file_,
+                stats += per_file_pipeline(
+                    job.path,
                     remote_folder=path,
                     success_folder=SUCCESS_FOLDER,
                     failure_folder=MANAGED_FOLDER,
+                    manifest_path=manifest_path,
+                    work_dir=work_dir,
                 )
             except OSError as exc:
-                logger.error("Error reading %s: %s", file_, exc)
+                logger.error("Error reading %s: %s", job.path, exc)
                 continue
 
+    report_path = args.report or (
+        MANAGED_FOLDER / time.strftime("report_%Y%m%d_%H%M%S.json")
+    )
+    logger.info("Writing report %s", report_path)
+    write_report(report_path, stats)
+
 
 if __name__ == "__main__":
     main()
@@ -1,49 +1,166 @@
 import argparse
 import logging
+import re
 import subprocess
-import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from pathlib import Path
-from zipfile import ZipFile
+from zipfile import ZipFile, ZipInfo
 
 import send2trash
 
 BD_FOLDER = Path("D:/Bédés")
 RAR_TYPES = ["[cC][bB][rR]", "[rR][aA][rR]"]
+# Books converted at the same time, each one by its own unrar process
+WORKERS = 4
+CHUNK_SIZE = 1024 * 1024
+FIELD_PATTERN = re.compile(r"^\s*([\w ]+?):\s(.*)$")
+
+
+@dataclass
+class Entry:
+    name: str
+    size: int
+    crc: int | None
+    date_time: tuple[int, int, int, int, int, int]
+
+
+def parse_date_time(value: str) -> tuple[int, int, int, int, int, int]:
+    # "2021-03-04 05:06:07,000000000"
+    try:
+        date, time_ = value.split()[:2]
+        year, month, day = (int(x) for x in date.split("-"))
+        hour, minute, second = (int(x) for x in time_.split(",")[0].split(":"))
+    except ValueError:
+        return time.localtime()[:6]
+    return year, month, day, hour, minute, second
+
+
+def list_entries(book: Path) -> list[Entry]:
+    # Files of the archive, in the order "unrar p" prints them
+    result = subprocess.run(["unrar", "lt", str(book)], check=True, capture_output=True)
+
+    blocks: list[dict[str, str]] = []
+    for line in result.stdout.decode(errors="replace").splitlines():
+        if not (match := FIELD_PATTERN.match(line)):
+            continue
+
+        key, value = match.group(1), match.group(2)
+        if key == "Name":
+            blocks.append({})
+        if blocks:
+            blocks[-1][key] = value
+
+    entries: list[Entry] = []
+    for block in blocks:
+        if block.get("Type", "File") != "File":
+            continue
+
+        crc = block.get("CRC32")
+        entries.append(
+            Entry(
+                block["Name"].replace("\\", "/"),
+                int(block["Size"]),
+                int(crc, 16) if crc else None,
+                parse_date_time(block.get("mtime", "")),
+            )
+        )
+    return entries
+
+
+def stream_entries(book: Path, entries: list[Entry], zip_: ZipFile) -> int:
+    # A single "unrar p" prints every file one after the other: split its
+    # output using the sizes from the listing. Solid archives are thus
+    # decompressed only once.
+    written = 0
+
+    with subprocess.Popen(
+        ["unrar", "p", "-inul", str(book)], stdout=subprocess.PIPE
+    ) as process:
+        assert process.stdout is not None
+
+        for entry in entries:
+            logging.debug("Writing %s", entry.name)
+            info = ZipInfo(entry.name, entry.date_time)
+            info.file_size = entry.size
+
+            crc = 0
+            remaining = entry.size
+            with zip_.open(info, "w") as file_:
+                while remaining:
+                    chunk = process.stdout.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise RuntimeError(f"{book}: {entry.name} is truncated")
+                    crc = zlib.crc32(chunk, crc)
+                    file_.write(chunk)
+                    remaining -= len(chunk)
+
+            if entry.crc is not None and crc != entry.crc:
+                raise RuntimeError(f"{book}: {entry.name} has a wrong CRC")
+            written += entry.size
+
+        if process.stdout.read(1):
+            raise RuntimeError(f"{book}: unrar printed more than listed")
+
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    return written
 
 
 def create_cbz(book: Path) -> Path:
-    with tempfile.TemporaryDirectory() as tmp:
-        if (cbz_book := book.with_suffix(".zip")).exists():
-            logging.info("CBZ exists. Removing %s", book)
-            send2trash.send2trash(book)
-            return cbz_book
-
-        logging.info("Extracting %s to %s", book, tmp)
-        try:
-            subprocess.run(
-                ["unrar", "e", str(book), str(tmp)],
-                check=True,
-                capture_output=True,
-            )
-        except subprocess.CalledProcessError as e:
-            if b"is not RAR archive" in e.stdout:
-                logging.warning("%s is not RAR archive", book)
-                raise
-            else:
-                logging.warning(e.stdout)
-                raise
+    if (cbz_book := book.with_suffix(".zip")).exists():
+        logging.info("CBZ exists. Removing %s", book)
+        send2trash.send2trash(book)
+        return cbz_book
+
+    try:
+        entries = list_entries(book)
+    except subprocess.CalledProcessError as e:
+        if b"is not RAR archive" in e.stdout:
+            logging.warning("%s is not RAR archive", book)
+            raise
         else:
-            logging.info("Creating %s", cbz_book)
+            logging.warning(e.stdout)
+            raise
+
+    logging.info("Creating %s", cbz_book)
+    start = time.perf_counter()
+    try:
+        with ZipFile(cbz_book, "w") as zip_:
+            written = stream_entries(book, entries, zip_)
+    except Exception:
+        cbz_book.unlink(missing_ok=True)
+        raise
+
+    elapsed = time.perf_counter() - start
+    logging.info(
+        "Converted %s: %d files, %.1f MB in %.1f s (%.1f MB/s)",
+        book,
+        len(entries),
+        written / 1e6,
+        elapsed,
+        written / 1e6 / elapsed if elapsed else 0,
+    )
 
-            with ZipFile(cbz_book, "w") as zip_:
-                for file_ in Path(tmp).iterdir():
-                    zip_.write(file_)
+    logging.info("Removing %s", book)
+    send2trash.send2trash(book)
 
-            logging.info("Removing %s", book)
-            send2trash.send2trash(book)
+    return cbz_book
 
-            book = cbz_book
-    return book
+
+def unrar(folder: Path, workers: int = WORKERS) -> None:
+    books = sorted(book for type_ in RAR_TYPES for book in folder.rglob(f"*.{type_}"))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(create_cbz, book): book for book in books}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as exc:
+                logging.error("Error converting %s: %s", futures[future], exc)
 
 
 def main():
@@ -55,6 +172,12 @@ def main():
         default=BD_FOLDER,
         nargs="?",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=WORKERS,
+        help="Books converted at the same time",
+    )
 
     args = parser.parse_args()
 
@@ -62,7 +185,7 @@ def main():
 
     logging.basicConfig(level=logging.INFO)
 
-    unrar(folders)
+    unrar(folders, args.workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Callable
+
+try:
+    from watchdog.events import FileSystemEvent, FileSystemEventHandler
+    from watchdog.observers import Observer
+    from watchdog.observers.polling import PollingObserver
+except ImportError:  # watch extra not installed
+    FileSystemEventHandler = object  # type: ignore[assignment,misc]
+    Observer = PollingObserver = None  # type: ignore[assignment,misc]
+
+logger = logging.getLogger("Sanitizer")
+
+# A file is handed over once its size and mtime did not change for this long
+STABLE_DELAY = 1.0
+CHECK_INTERVAL = 0.25
+
+
+class StableFiles:
+    # Files being written, until their size and mtime stop changing
+
+    def __init__(self, delay: float = STABLE_DELAY) -> None:
+        self.delay = delay
+        self.lock = threading.Lock()
+        # path -> (size, mtime, time of the last change)
+        self.pending: dict[Path, tuple[int, float, float]] = {}
+
+    def touch(self, path: Path) -> None:
+        with self.lock:
+            self.pending[path] = (-1, -1.0, time.monotonic())
+
+    def pop_stable(self) -> list[Path]:
+        now = time.monotonic()
+        stable: list[Path] = []
+
+        with self.lock:
+            for path, (size, mtime, since) in list(self.pending.items()):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    del self.pending[path]
+                    continue
+
+                if (stat.st_size, stat.st_mtime) != (size, mtime):
+                    self.pending[path] = (stat.st_size, stat.st_mtime, now)
+                elif now - since >= self.delay:
+                    del self.pending[path]
+                    stable.append(path)
+
+        return stable
+
+
+class BookHandler(FileSystemEventHandler):
+    def __init__(self, folder: Path, suffixes: list[str], files: StableFiles):
+        super().__init__()
+        self.folder = folder.resolve()
+        self.suffixes = suffixes
+        self.files = files
+
+    def _touch(self, path: str) -> None:
+        file_ = Path(path)
+        if file_.suffix.lower() not in self.suffixes:
+            return
+        # Books sent to the trash are moved out of the folder
+        if not file_.resolve().is_relative_to(self.folder):
+            return
+
+        self.files.touch(file_)
+
+    def on_created(self, event: FileSystemEvent) -> None:
+        if not event.is_directory:
+            self._touch(event.src_path)
+
+    def on_modified(self, event: FileSystemEvent) -> None:
+        if not event.is_directory:
+            self._touch(event.src_path)
+
+    def on_moved(self, event: FileSystemEvent) -> None:
+        if not event.is_directory:
+            self._touch(event.dest_path)
+
+
+def watch(
+    folder: Path,
+    suffixes: list[str],
+    on_stable: Callable[[Path], None],
+    poll: bool = False,
+    delay: float = STABLE_DELAY,
+) -> None:
+    # Call on_stable with every book written to folder, once complete. Polling
+    # is slower but works on network shares, where inotify gets no event.
+    if Observer is None:
+        raise RuntimeError("Watching needs watchdog: pip install range-bd[watch]")
+
+    files = StableFiles(delay)
+    observer = PollingObserver() if poll else Observer()
+    observer.schedule(BookHandler(folder, suffixes, files), str(folder), recursive=True)
+    observer.start()
+    logger.info("Watching %s", folder)
+
+    try:
+        while True:
+            time.sleep(CHECK_INTERVAL)
+            for path in files.pop_stable():
+                logger.info("New book %s", path)
+                on_stable(path)
+    finally:
+        observer.stop()
+        observer.join()
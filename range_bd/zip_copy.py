@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import struct
+from zipfile import ZipFile, ZipInfo, _strip_extra  # type: ignore[attr-defined]
+
+# Local file header: signature, versions, flags, compression, times, CRC,
+# sizes, then the lengths of the name and of the extra field
+LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+ZIP64_EXTRA = 0x0001
+# Sizes and CRC come after the data instead of in the local header
+DATA_DESCRIPTOR_FLAG = 0x08
+
+
+def read_raw(source: ZipFile, info: ZipInfo) -> bytes:
+    # Compressed bytes of a member, as stored in the archive
+    assert source.fp is not None
+
+    with source._lock:  # type: ignore[attr-defined]
+        source.fp.seek(info.header_offset)
+        header = LOCAL_HEADER.unpack(source.fp.read(LOCAL_HEADER.size))
+        if header[0] != LOCAL_HEADER_SIGNATURE:
+            raise ValueError(f"Bad local header for {info.filename}")
+
+        name_length, extra_length = header[-2:]
+        source.fp.seek(name_length + extra_length, 1)
+        return source.fp.read(info.compress_size)
+
+
+def copy_member(
+    source: ZipFile,
+    info: ZipInfo,
+    destination: ZipFile,
+    name: str | None = None,
+) -> ZipInfo:
+    # Copy a member without decompressing and recompressing it, optionally
+    # under a new name
+    raw = read_raw(source, info)
+
+    new_info = ZipInfo(name or info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.comment = info.comment
+    new_info.extra = _strip_extra(info.extra, (ZIP64_EXTRA,))
+    new_info.create_system = info.create_system
+    new_info.create_version = info.create_version
+    new_info.extract_version = info.extract_version
+    new_info.internal_attr = info.internal_attr
+    new_info.external_attr = info.external_attr
+    new_info.flag_bits = info.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+
+    # Same bookkeeping as ZipFile.writestr, with the data written as is
+    with destination._lock:  # type: ignore[attr-defined]
+        if destination._writing:  # type: ignore[attr-defined]
+            raise ValueError("Can't write to the ZIP file while a member is open")
+        destination._writecheck(new_info)  # type: ignore[attr-defined]
+        destination._didModify = True  # type: ignore[attr-defined]
+
+        assert destination.fp is not None
+        if destination._seekable:  # type: ignore[attr-defined]
+            destination.fp.seek(destination.start_dir)  # type: ignore[attr-defined]
+        new_info.header_offset = destination.fp.tell()
+        destination.fp.write(new_info.FileHeader())
+        destination.fp.write(raw)
+
+        destination.filelist.append(new_info)
+        destination.NameToInfo[new_info.filename] = new_info
+        destination.start_dir = destination.fp.tell()  # type: ignore[attr-defined]
+
+    return new_info
@@ -0,0 +1,417 @@
+from __future__ import annotations
+
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from queue import Queue
+from string import Template
+from typing import Iterator
+from urllib.parse import parse_qs, urlsplit
+from zipfile import ZipFile
+
+import pytest
+from PIL import Image
+
+from range_bd.manifest import CaptureManifest
+
+importer = pytest.importorskip("range_bd.importer")
+
+from selenium.common.exceptions import WebDriverException  # noqa: E402
+from selenium.webdriver import Firefox, FirefoxOptions  # noqa: E402
+from selenium.webdriver.common.keys import Keys  # noqa: E402
+
+# Local stand-in for the izneo site, served from SITE_FOLDER
+SITE_FOLDER = Path(__file__).parent / "importer_site"
+# The reader moves its counter TURN_DELAY after a page turn, then the image
+# of the page takes IMAGE_DELAY to arrive
+TURN_DELAY = 0.2
+IMAGE_DELAY = 0.3
+PAGE_SIZE = (300, 400)
+# Colour of each page, so that a capture tells which page it shows
+PALETTE = [
+    (230, 40, 40),
+    (40, 200, 40),
+    (40, 40, 230),
+    (230, 200, 40),
+    (200, 40, 200),
+    (40, 200, 200),
+]
+
+
+@dataclass
+class Album:
+    series: str
+    number: str
+    pages: int
+
+
+ALBUMS = {
+    "1001": Album("Serie", "1", 4),
+    "1002": Album("Serie", "2", 3),
+    "1003": Album("Autre serie", "1", 3),
+}
+# Credentials posted to the login form
+LOGINS: list[tuple[str, str]] = []
+
+
+def page_colour(page: int) -> tuple[int, int, int]:
+    return PALETTE[(page - 1) % len(PALETTE)]
+
+
+class SiteHandler(BaseHTTPRequestHandler):
+    # /fr/login for the login form, /fr/serie/<name> for the list of the
+    # albums, /fr/bd/<series>/album-<id> for the details of an album,
+    # .../album-<id>/read/<page> for its reader and /page/<id>/<page>.png
+    # for the image of a page
+
+    def do_GET(self) -> None:
+        parts = urlsplit(self.path).path.strip("/").split("/")
+
+        if parts[-1] == "login":
+            self.send_html("login.html")
+        elif parts == ["fr"]:
+            login = LOGINS[-1][0] if LOGINS else ""
+            self.send_html("home.html", login=login)
+        elif parts[:2] == ["fr", "serie"]:
+            albums = "\n".join(
+                f'<div class="album-data"><a href="/fr/bd/serie/album-{album_id}'
+                f'?origin=serie">T{album.number}</a></div>'
+                for album_id, album in ALBUMS.items()
+            )
+            self.send_html("series.html", albums=albums)
+        elif parts[0] == "page":
+            self.send_page(int(Path(parts[2]).stem))
+        elif len(parts) > 2 and parts[-2] == "read":
+            album_id = importer.get_tome_id("/".join(parts[:-2]))
+            self.send_html(
+                "reader.html",
+                album=album_id,
+                pages=ALBUMS[album_id].pages,
+                turn_delay=int(TURN_DELAY * 1000),
+            )
+        elif parts[-1].startswith("album-"):
+            album_id = importer.get_tome_id(parts[-1])
+            album = ALBUMS[album_id]
+            self.send_html(
+                "album.html", album=album_id, series=album.series, number=album.number
+            )
+        else:
+            self.send_error(404)
+
+    def do_POST(self) -> None:
+        length = int(self.headers["Content-Length"])
+        form = parse_qs(self.rfile.read(length).decode())
+        LOGINS.append((form["login"][0], form["password"][0]))
+
+        self.send_response(303)
+        self.send_header("Location", "/fr/")
+        self.end_headers()
+
+    def send_html(self, name: str, **values: object) -> None:
+        body = Template((SITE_FOLDER / name).read_text("utf-8")).substitute(values)
+        self.send_body(body.encode(), "text/html; charset=utf-8")
+
+    def send_page(self, page: int) -> None:
+        time.sleep(IMAGE_DELAY)
+        buffer = BytesIO()
+        Image.new("RGB", PAGE_SIZE, page_colour(page)).save(buffer, "PNG")
+        self.send_body(buffer.getvalue(), "image/png")
+
+    def send_body(self, body: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture(scope="module")
+def site() -> Iterator[str]:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SiteHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def album_url(site: str, album_id: str) -> str:
+    return f"{site}/fr/bd/serie/album-{album_id}"
+
+
+@pytest.fixture
+def firefox() -> None:
+    if shutil.which("firefox") is None:
+        pytest.skip("Firefox is not installed")
+
+
+@pytest.fixture
+def driver(firefox: None) -> Iterator[Firefox]:
+    options = FirefoxOptions()
+    options.add_argument("-headless")
+    driver = Firefox(options=options)
+    driver.set_window_size(800, 600)
+    try:
+        yield driver
+    finally:
+        driver.quit()
+
+
+@pytest.fixture
+def bede_folder(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    monkeypatch.setattr(importer, "BEDE_FOLDER", tmp_path)
+    return tmp_path
+
+
+def captured_page(png: bytes) -> int:
+    # Page of the palette covering most of a capture
+    with Image.open(BytesIO(png)) as image:
+        colours = image.convert("RGB").getcolors(image.width * image.height)
+    counts = {page: 0 for page in range(1, len(PALETTE) + 1)}
+    for count, colour in colours:
+        for page in counts:
+            if max(abs(a - b) for a, b in zip(colour, page_colour(page))) < 8:
+                counts[page] += count
+    return max(counts, key=lambda page: counts[page])
+
+
+def test_download_captures_each_page_once(
+    site: str, driver: Firefox, bede_folder: Path
+) -> None:
+    album = ALBUMS["1001"]
+    path = importer.download(driver, album_url(site, "1001"))
+
+    assert path == bede_folder / album.series / f"{album.series} #1.zip"
+    with ZipFile(path) as cbz_file:
+        names = cbz_file.namelist()
+        pages = [captured_page(cbz_file.read(name)) for name in names]
+
+    # A page captured before its counter advanced or its image arrived would
+    # show the previous page
+    assert len(names) == len(set(names)) == album.pages
+    assert pages == list(range(1, album.pages + 1))
+
+
+def test_go_to_page_moves_the_slider(site: str, driver: Firefox) -> None:
+    driver.get(album_url(site, "1001") + "/read/1")
+    timer = importer.PageTimer()
+    importer.wait_for_page(driver, 1, timer)
+
+    importer.go_to_page(driver, 3, 1, Keys.ARROW_RIGHT, Keys.ARROW_LEFT, timer)
+
+    assert importer.read_page(driver, importer.CURRENT_PAGE_ID) == 3
+    assert driver.execute_script(importer.IMAGES_LOADED_SCRIPT)
+    assert driver.execute_script("return keyPresses;") == 0
+
+
+class FakeDriver:
+    def __init__(self) -> None:
+        self.quit_calls = 0
+
+    def quit(self) -> None:
+        self.quit_calls += 1
+
+
+def album_queue(*urls: str) -> Queue[tuple[str, int]]:
+    queue: Queue[tuple[str, int]] = Queue()
+    for url in urls:
+        queue.put((url, 0))
+    return queue
+
+
+def test_run_session_stops_between_albums(monkeypatch: pytest.MonkeyPatch) -> None:
+    stop = threading.Event()
+    drivers: list[FakeDriver] = []
+    downloaded: list[str] = []
+
+    def new_driver(username: str, password: str) -> FakeDriver:
+        drivers.append(FakeDriver())
+        return drivers[-1]
+
+    def download(driver, url, *args) -> Path:
+        downloaded.append(url)
+        stop.set()
+        return Path(url)
+
+    monkeypatch.setattr(importer, "new_driver", new_driver)
+    monkeypatch.setattr(importer, "download", download)
+    urls = album_queue("a", "b", "c")
+
+    importer.run_session(
+        0, "user", "secret", urls, importer.RateLimiter(0), importer.Progress(3), stop
+    )
+
+    assert downloaded == ["a"]
+    assert urls.qsize() == 2
+    assert [driver.quit_calls for driver in drivers] == [1]
+
+
+def test_run_session_does_not_retry_once_stopped(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    stop = threading.Event()
+
+    def download(driver, url, *args) -> Path:
+        # As when Ctrl-C also reaches the browser
+        stop.set()
+        raise RuntimeError("Browser closed")
+
+    monkeypatch.setattr(importer, "new_driver", lambda *args: FakeDriver())
+    monkeypatch.setattr(importer, "download", download)
+    urls = album_queue("a")
+    progress = importer.Progress(1)
+
+    importer.run_session(
+        0, "user", "secret", urls, importer.RateLimiter(0), progress, stop
+    )
+
+    assert urls.empty()
+    assert progress.finished == 1
+
+
+def test_drain_empties_the_queue() -> None:
+    urls = album_queue("a", "b")
+    importer.drain(urls)
+    assert urls.empty()
+
+
+class StoppingLimiter(importer.RateLimiter):
+    # Set stop on the given call to wait
+
+    def __init__(self, stop: threading.Event, calls: int) -> None:
+        super().__init__(0)
+        self.stop = stop
+        self.calls = calls
+
+    def wait(self) -> None:
+        self.calls -= 1
+        if not self.calls:
+            self.stop.set()
+
+
+def test_download_stops_at_page_turn(
+    site: str, driver: Firefox, bede_folder: Path
+) -> None:
+    stop = threading.Event()
+    # Details, reader, then one call after each page
+    limiter = StoppingLimiter(stop, 4)
+
+    path = importer.download(driver, album_url(site, "1001"), limiter, stop=stop)
+
+    with ZipFile(path) as cbz_file:
+        assert len(cbz_file.namelist()) == 2
+
+
+def test_sessions_share_the_albums(
+    site: str, firefox: None, bede_folder: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(importer, "BASE_URL", site)
+    monkeypatch.setattr(importer, "LOGIN_URL", f"{site}/fr/login")
+    LOGINS.clear()
+
+    driver = importer.new_driver("user", "secret")
+    try:
+        urls = importer.get_all_tomes_from_series(driver, f"{site}/fr/serie/serie")
+    finally:
+        driver.quit()
+    assert urls == [album_url(site, album_id) for album_id in ALBUMS]
+
+    # The first attempt at the second album fails once its browser is started
+    download = importer.download
+    failures: list[str] = []
+
+    def flaky_download(driver, url, *args) -> Path | None:
+        if url == urls[1] and not failures:
+            failures.append(url)
+            raise WebDriverException("Injected failure")
+        return download(driver, url, *args)
+
+    monkeypatch.setattr(importer, "download", flaky_download)
+    queue = album_queue(*urls)
+    progress = importer.Progress(len(urls))
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        sessions = [
+            executor.submit(
+                importer.run_session,
+                index,
+                "user",
+                "secret",
+                queue,
+                importer.RateLimiter(0),
+                progress,
+                stop,
+            )
+            for index in range(2)
+        ]
+    for session in sessions:
+        session.result()
+
+    assert failures == [urls[1]]
+    assert progress.finished == len(urls)
+    # One browser per session, and another one after the failure
+    assert len(LOGINS) >= 3
+    assert set(LOGINS) == {("user", "secret")}
+    for album in ALBUMS.values():
+        path = bede_folder / album.series / f"{album.series} #{album.number}.zip"
+        with ZipFile(path) as cbz_file:
+            pages = [captured_page(cbz_file.read(name)) for name in cbz_file.namelist()]
+        assert pages == list(range(1, album.pages + 1))
+
+
+def test_packer_reports_the_pages_written(tmp_path: Path) -> None:
+    written: list[int] = []
+    pngs = []
+    for page in range(1, 6):
+        buffer = BytesIO()
+        Image.new("RGB", PAGE_SIZE, page_colour(page)).save(buffer, "PNG")
+        pngs.append(buffer.getvalue())
+
+    with importer.PagePacker(
+        tmp_path / "album.zip", workers=1, on_write=written.append
+    ) as packer:
+        for page, png in enumerate(pngs, 1):
+            packer.add(f"{page}.png", png)
+
+    assert written == sorted(written)
+    assert written[-1] == packer.written == len(pngs)
+    with ZipFile(tmp_path / "album.zip") as cbz_file:
+        assert len(cbz_file.namelist()) == len(pngs)
+
+
+def test_download_resumes_after_the_pages_written(
+    site: str, driver: Firefox, bede_folder: Path
+) -> None:
+    album = ALBUMS["1001"]
+    stop = threading.Event()
+
+    with CaptureManifest(bede_folder / importer.CAPTURES_NAME) as captures:
+        path = importer.download(
+            driver,
+            album_url(site, "1001"),
+            StoppingLimiter(stop, 4),
+            captures=captures,
+            stop=stop,
+        )
+        entry = captures.get("1001")
+        assert entry is not None
+        assert (entry.captured, entry.output) == (2, path)
+
+        importer.download(driver, album_url(site, "1001"), captures=captures)
+        entry = captures.get("1001")
+        assert entry is not None and entry.finished
+
+    with ZipFile(path) as cbz_file:
+        pages = [captured_page(cbz_file.read(name)) for name in cbz_file.namelist()]
+    assert pages == list(range(1, album.pages + 1))